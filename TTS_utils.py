@@ -1,40 +1,111 @@
 from pathlib import Path
-import openai
 import os
-import KEYS
 import random
 import argparse
-
-# client = OpenAI()
-# setting up the openai api key
-openai.api_key = KEYS.OPENAI_KEY
+import hashlib
+import threading
+import tempfile
+import io
+import wave
+import http_utils
+from cache_utils import TTSCache
+from utils import log_and_print
 
 voice_list = ['alloy', 'echo', 'fable', 'onyx', 'nova', 'shimmer']
+tts_model = "tts-1"
 
-def openai_tts(speech_text, prefix=None, voice='alloy'):
+# 語音格式：mp3（預設）、opus（傳輸量最小，Ogg 容器）、pcm（不需解碼，延遲最低）
+# pcm 為 24kHz 16-bit 單聲道，收到後加上 WAV header，播放端不需要另外指定格式
+audio_formats = {'mp3': 'mp3', 'opus': 'ogg', 'pcm': 'wav'}  # {格式: 副檔名}
+audio_format = 'mp3'
+PCM_SAMPLE_RATE = 24000
+
+def set_audio_format(fmt):
+    global audio_format
+    if fmt not in audio_formats:
+        raise ValueError(f"audio format must be one of {list(audio_formats)}")
+    audio_format = fmt
+
+def file_extension():
+    return audio_formats[audio_format]
+
+def pcm_to_wav(pcm, sample_rate=PCM_SAMPLE_RATE):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(pcm)
+    return buffer.getvalue()
+
+# 磁碟上的 TTS 快取，enable_cache() 之後才會使用
+tts_cache = None
+
+def enable_cache(cache_dir='cache/tts', max_bytes=100 * 1024 * 1024):
+    global tts_cache
+    tts_cache = TTSCache(cache_dir, max_bytes=max_bytes)
+    return tts_cache
+
+def text_hash(*parts):
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+def pick_voice(speech_text):
+    """由文字的 hash 決定聲音，同樣的文字每次都選到同一個聲音，快取才有機會命中。"""
+    return voice_list[int(text_hash(speech_text)[:8], 16) % len(voice_list)]
+
+def openai_tts_bytes(speech_text, voice='alloy'):
+    """
+    回傳語音的 bytes（不落地，格式依 audio_format），快取命中時直接從快取讀取。
+    """
     if voice == 'random':
-        voice = random.choice(voice_list)
-    if prefix:
-        save_name = f'{prefix}.mp3'
-    else:
-        save_name = f'{voice}.mp3'
-    save_path = f'{save_name}'
-    # headers = {
-    #     "Content-Type": "application/json",
-    #     "Authorization": f'Bearer {KEYS.OPENAI_KEY}'
-    # }
-    # payload = {
-    #     "model": 'tts-1', 
-        
-    # }
-    with openai.audio.speech.with_streaming_response.create(
-        model="tts-1",
-        voice=voice,
-        input=speech_text
-    ) as response:
-        response.stream_to_file(save_path)
-        # print(f"Saved to {save_path}")
+        voice = pick_voice(speech_text)
+    cache_key = text_hash(tts_model, voice, audio_format, speech_text)
+    if tts_cache is not None:
+        cached_path = tts_cache.get(cache_key)
+        if cached_path is not None:
+            with open(cached_path, 'rb') as f:
+                return f.read()
+    payload = {
+        "model": tts_model,
+        "voice": voice,
+        "input": speech_text,
+        "response_format": audio_format
+    }
+    # 與 gpt_utils 共用連線池 session，邊接收邊寫入記憶體
+    audio = bytearray()
+    with http_utils.post("/audio/speech", payload, stream=True) as response:
+        for chunk in response.iter_content(chunk_size=16 * 1024):
+            audio.extend(chunk)
+    audio = pcm_to_wav(audio) if audio_format == 'pcm' else bytes(audio)
+    if tts_cache is not None:
+        tts_cache.put(cache_key, audio, ext=file_extension())
+    return audio
+
+spool_dir = 'spool'
+
+def openai_tts(speech_text, prefix=None, voice='alloy'):
+    """
+    需要檔案時使用：寫到 spool 目錄下不重複的檔名並回傳路徑，
+    同時觸發的請求不會互相覆蓋。
+    """
+    audio = openai_tts_bytes(speech_text, voice=voice)
+    os.makedirs(spool_dir, exist_ok=True)
+    fd, save_path = tempfile.mkstemp(suffix=f'.{file_extension()}', prefix=f'{prefix or voice}_', dir=spool_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(audio)
     return save_path
+
+def prepopulate(texts, voice='random'):
+    """在背景先把已知的固定文字轉成語音放進快取。"""
+    def _prepopulate():
+        for text in texts:
+            try:
+                openai_tts_bytes(text, voice=voice)
+            except http_utils.APIError as e:
+                log_and_print(f"TTS prepopulate failed for {text[:20]}: {e}", 'warning')
+        if tts_cache is not None:
+            log_and_print(f"TTS cache ready: {tts_cache.stats()}", 'info')
+    threading.Thread(target=_prepopulate, daemon=True).start()
     
 
 
@@ -58,6 +129,8 @@ if __name__ == "__main__":
     parser.add_argument('--text', type=str, help='text to be converted to speech')
     parser.add_argument('--voice', type=str, default='alloy', help='voice to be used')
     parser.add_argument('--prefix', type=str, default=None, help='prefix for the file name')
+    parser.add_argument('--format', type=str, default='mp3', choices=list(audio_formats), help='audio format')
     args = parser.parse_args()
+    set_audio_format(args.format)
 
     openai_tts(args.text, prefix=args.prefix, voice=args.voice)
\ No newline at end of file
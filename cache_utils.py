@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import shutil
+import threading
+import atexit
+import cv2
+import numpy as np
+from utils import log_and_print
+
+
+class DiskLRU:
+    """
+    以目錄保存檔案的 LRU 快取。
+    index.json 記錄每個 entry 的檔案、總大小與最後使用時間，
+    超過 max_bytes 或 max_entries 時從最久沒用到的 entry 開始刪除。
+    命中時只更新記憶體中的使用時間，index 在新增/刪除時寫入，其餘每 flush_interval 秒與程式結束時寫回。
+    """
+
+    def __init__(self, cache_dir, max_bytes=200 * 1024 * 1024, max_entries=None, flush_interval=30.0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()  # 寫 index 檔案時使用，不佔用 self.lock
+        self.dirty = False
+        self.version = 0  # 每次取 index 快照加一，避免較舊的快照覆蓋較新的 index 檔案
+        self.written_version = 0
+        self.flush_interval = flush_interval
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self._load_index()
+        atexit.register(self.flush)
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            log_and_print(f"Cache index {self.index_path} unreadable, starting empty: {e}", 'warning')
+            return {}
+        # 檔案被手動刪除的 entry 直接略過
+        return {key: entry for key, entry in index.items()
+                if all(os.path.exists(self.path(name)) for name in entry.get('files', []))}
+
+    def _save_index(self):
+        # 呼叫端需持有 self.lock（新增/刪除 entry 時）
+        self.version += 1
+        self.dirty = False
+        self._write_index(json.dumps(self.index, ensure_ascii=False), self.version)
+
+    def _write_index(self, data, version):
+        with self.write_lock:
+            if version <= self.written_version:
+                return
+            self.written_version = version
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, self.index_path)
+
+    def flush(self):
+        """把命中時更新的使用時間寫回 index；檔案寫入時不持有 self.lock。"""
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self.index, ensure_ascii=False)
+            self.version += 1
+            version = self.version
+            self.dirty = False
+        self._write_index(data, version)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                log_and_print(f"Cache index {self.index_path} flush failed: {e}", 'warning')
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def total_bytes(self):
+        return sum(entry['size'] for entry in self.index.values())
+
+    def _touch(self, key):
+        self.index[key]['last_used'] = time.time()
+        self.dirty = True
+
+    def _put(self, key, entry, files):
+        """
+        files 為 {快取內檔名: 來源（路徑或 bytes）}，複製到快取目錄後記錄 entry。
+        呼叫端需持有 self.lock。
+        """
+        size = 0
+        for name, source in files.items():
+            if isinstance(source, (bytes, bytearray)):
+                with open(self.path(name), 'wb') as f:
+                    f.write(source)
+            else:
+                shutil.copyfile(source, self.path(name))
+            size += os.path.getsize(self.path(name))
+        if key in self.index:
+            self._remove(key, keep=set(files))
+        entry['files'] = list(files)
+        entry['size'] = size
+        entry['last_used'] = time.time()
+        self.index[key] = entry
+        self._evict()
+        self._save_index()
+
+    def _remove(self, key, keep=()):
+        entry = self.index.pop(key)
+        for name in entry.get('files', []):
+            if name in keep:
+                continue
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        by_age = sorted(self.index, key=lambda k: self.index[k]['last_used'])
+        total = self.total_bytes()
+        while by_age and (total > self.max_bytes or
+                          (self.max_entries is not None and len(self.index) > self.max_entries)):
+            key = by_age.pop(0)
+            total -= self.index[key]['size']
+            self._remove(key)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.index),
+                'bytes': self.total_bytes(),
+            }
+
+
+def dhash(image, hash_size=16):
+    """difference hash：縮成 (hash_size+1) x hash_size 的灰階圖，比較左右相鄰像素。"""
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(image, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class PerceptualCache(DiskLRU):
+    """
+    以影像的 perceptual hash 為 key，保存產生過的文字與音檔。
+    同一個物品再次放上展台時，hash 的 Hamming distance 在 max_distance 內即視為命中。
+    """
+
+    def __init__(self, cache_dir='cache/content', max_distance=10, max_bytes=200 * 1024 * 1024, max_entries=500):
+        super().__init__(cache_dir, max_bytes=max_bytes, max_entries=max_entries)
+        self.max_distance = max_distance
+
+    def lookup(self, image_hash):
+        """回傳最接近的 entry（含 texts 與 audio 的完整路徑），沒有命中則回傳 None。"""
+        with self.lock:
+            best_key, best_distance = None, self.max_distance + 1
+            for key, entry in self.index.items():
+                distance = hamming_distance(image_hash, int(entry['hash'], 16))
+                if distance < best_distance:
+                    best_key, best_distance = key, distance
+            if best_key is None:
+                self.misses += 1
+                log_and_print(f"Content cache miss ({self.hits} hits / {self.misses} misses)", 'info')
+                return None
+            self.hits += 1
+            self._touch(best_key)
+            entry = self.index[best_key]
+            log_and_print(f"Content cache hit, distance {best_distance} ({self.hits} hits / {self.misses} misses)", 'info')
+            return {
+                'texts': dict(entry['texts']),
+                'audio': {type: [self.path(name) for name in names] for type, names in entry['audio'].items()},
+            }
+
+    def store(self, image_hash, texts, audio, ext='mp3'):
+        """texts 為 {type: text}，audio 為 {type: [音檔路徑或 bytes, ...]}（依播放順序），ext 為音檔副檔名。"""
+        key = format(image_hash, 'x')
+        files = {}
+        audio_names = {}
+        for type, sources in audio.items():
+            audio_names[type] = []
+            for i, source in enumerate(sources):
+                name = f'{key}_{type}_{i}.{ext}'
+                files[name] = source
+                audio_names[type].append(name)
+        with self.lock:
+            self._put(key, {'hash': key, 'texts': dict(texts), 'audio': audio_names}, files)
+
+
+class TTSCache(DiskLRU):
+    """以 (model, voice, text) 的 hash 為 key 的 TTS 音檔快取。"""
+
+    def __init__(self, cache_dir='cache/tts', max_bytes=100 * 1024 * 1024):
+        super().__init__(cache_dir, max_bytes=max_bytes)
+
+    def get(self, key):
+        """命中時回傳快取中的音檔路徑，否則回傳 None。"""
+        with self.lock:
+            if key not in self.index:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touch(key)
+            return self.path(self.index[key]['files'][0])
+
+    def put(self, key, source, ext='mp3'):
+        """source 為音檔路徑或 bytes，回傳快取中的路徑。"""
+        name = f'{key}.{ext}'
+        with self.lock:
+            self._put(key, {}, {name: source})
+        return self.path(name)
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import threading
+from device_ip import inv_addr_dict
+from utils import log_and_print
+
+# 裝置探索使用的 UDP port（web_socket 的 TCP port 為 12345）
+DISCOVERY_PORT = 12346
+DISCOVERY_MAGIC = "pedestal"
+
+
+def discover_message():
+    return json.dumps({"magic": DISCOVERY_MAGIC, "type": "discover"}).encode()
+
+
+def announce_message(name, port):
+    return json.dumps({"magic": DISCOVERY_MAGIC, "type": "announce", "name": name, "port": port}).encode()
+
+
+def parse_message(data):
+    try:
+        message = json.loads(data.decode())
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return None
+    if not isinstance(message, dict) or message.get("magic") != DISCOVERY_MAGIC:
+        return None
+    return message
+
+
+class DiscoveryResponder(asyncio.DatagramProtocol):
+    """Pi 端：收到 discover 時回覆自己的名稱與 port。"""
+
+    def __init__(self, name, port):
+        self.name = name
+        self.port = port
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        message = parse_message(data)
+        if message is not None and message.get("type") == "discover":
+            self.transport.sendto(announce_message(self.name, self.port), addr)
+
+
+class DeviceRegistry:
+    """
+    伺服器端的裝置清單：以 device_ip.addr_dict 為初始值，並用 UDP 探索更新各裝置的位址。
+    每 probe_interval 秒對 broadcast 與已知位址送出 discover，有回覆的裝置視為 healthy；
+    超過 stale_after 秒沒有回覆就視為離線，觸發時直接略過，不必等 TCP timeout；
+    啟動後尚未回覆過的裝置在第一輪探索逾時（stale_after）前仍視為 healthy。
+    探索到的位址存在 cache_path，重新啟動後直接使用。
+    """
+
+    def __init__(self, names=None, probe_interval=2.0, stale_after=None, cache_path='cache/devices.json',
+                 broadcast_address='<broadcast>'):
+        self.names = list(names) if names is not None else list(inv_addr_dict)
+        self.probe_interval = probe_interval
+        self.stale_after = stale_after if stale_after is not None else probe_interval * 3
+        self.cache_path = cache_path
+        self.broadcast_address = broadcast_address
+        self.lock = threading.Lock()
+        self.addresses = {name: (ip, None) for name, ip in inv_addr_dict.items()}
+        self.addresses.update(self._load_cache())
+        self.last_seen = {}
+        self.address_seen = {}  # {(name, ip, port): 最後收到回覆的時間}
+        self.health = {}
+        self.started = time.monotonic()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.socket.bind(('', 0))
+        threading.Thread(target=self._listen, daemon=True).start()
+        threading.Thread(target=self._probe, daemon=True).start()
+
+    def _load_cache(self):
+        if not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                return {name: tuple(address) for name, address in json.load(f).items()}
+        except (OSError, json.JSONDecodeError, TypeError) as e:
+            log_and_print(f"Device cache {self.cache_path} unreadable: {e}", 'warning')
+            return {}
+
+    def _save_cache(self, addresses):
+        os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(addresses, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def address(self, name):
+        """回傳 (ip, port)；port 為 None 表示使用預設 port。"""
+        with self.lock:
+            return self.addresses.get(name, (None, None))
+
+    def healthy(self, name):
+        with self.lock:
+            last_seen = self.last_seen.get(name)
+        # 還沒收到回覆時從啟動時間起算，第一輪探索逾時前不把裝置當成離線
+        return time.monotonic() - (last_seen if last_seen is not None else self.started) < self.stale_after
+
+    def healthy_devices(self):
+        return [name for name in self.names if self.healthy(name)]
+
+    def _listen(self):
+        while True:
+            try:
+                data, (ip, _) = self.socket.recvfrom(1024)
+            except OSError as e:
+                log_and_print(f"Device discovery receive failed: {e}", 'warning')
+                time.sleep(self.probe_interval)
+                continue
+            message = parse_message(data)
+            if message is None or message.get("type") != "announce" or not message.get("name"):
+                continue
+            name, port = message["name"], message.get("port")
+            now = time.monotonic()
+            with self.lock:
+                self.address_seen[(name, ip, port)] = now
+                self.last_seen[name] = now
+                # 同一台裝置可能從多個位址回覆（broadcast 與直接詢問），目前的位址仍有回應時不更換
+                current = self.addresses.get(name)
+                current_seen = self.address_seen.get((name, *current)) if current else None
+                changed = current != (ip, port) and (current_seen is None or now - current_seen >= self.stale_after)
+                if changed:
+                    self.addresses[name] = (ip, port)
+                    addresses = dict(self.addresses)
+            if changed:
+                try:
+                    self._save_cache(addresses)
+                except OSError as e:
+                    log_and_print(f"Device cache {self.cache_path} not saved: {e}", 'warning')
+                log_and_print(f"[{name}] Discovered at {ip}:{port}", 'info')
+
+    def _probe(self):
+        while True:
+            targets = {(self.broadcast_address, DISCOVERY_PORT)}
+            with self.lock:
+                # 不同網段時 broadcast 到不了，已知位址另外直接詢問
+                targets.update((ip, DISCOVERY_PORT) for name, (ip, _) in self.addresses.items()
+                               if name in self.names and ip)
+            for target in targets:
+                try:
+                    self.socket.sendto(discover_message(), target)
+                except OSError as e:
+                    log_and_print(f"Device discovery to {target[0]} failed: {e}", 'debug')
+            time.sleep(self.probe_interval)
+            for name in self.names:
+                healthy = self.healthy(name)
+                if self.health.get(name) != healthy:
+                    self.health[name] = healthy
+                    log_and_print(f"[{name}] {'healthy' if healthy else 'unreachable'}",
+                                  'info' if healthy else 'warning')
@@ -2,10 +2,12 @@ import base64
 import cv2
 import numpy as np
 from openai import OpenAI
-import KEYS
-import requests
 import json
+import math
+import re
 from utils import log_and_print
+import http_utils
+from http_utils import APIResponseError
 import logging
 
 def image2base64(img:np.ndarray)->str:
@@ -22,11 +24,87 @@ def npimageResize(npimg:np.ndarray, scale_ratio:float)->np.ndarray:
     img = cv2.resize(npimg, (int(npimg.shape[1]*scale_ratio), int(npimg.shape[0]*scale_ratio)))
     return img
 
-def call_api(image_base64:str, instruction:str):
-    headers = {
-            "Content-Type": "application/json",
-            "Authorization": f'Bearer {KEYS.OPENAI_KEY}'
-        }
+# 每個模型的圖片 token 計算參數：(base tokens, 每個 512x512 tile 的 tokens)
+image_token_costs = {
+    'gpt-4o-mini': (2833, 5667),
+    'gpt-4o': (85, 170),
+}
+
+def estimate_image_tokens(width:int, height:int, detail:str='auto', model:str='gpt-4o-mini')->int:
+    """依 OpenAI 的計算方式估計圖片的 prompt tokens（auto 以 high 估計）。"""
+    base, per_tile = image_token_costs[model]
+    if detail == 'low':
+        return base
+    # 先縮到 2048x2048 以內，再把短邊縮到 768，以 512x512 tile 計算
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return base + per_tile * tiles
+
+# encode_image 降低 JPEG 品質時的下限
+MIN_JPEG_QUALITY = 40
+
+class ImagePayload:
+    """
+    已編碼好、要送給 API 的圖片：base64 JPEG 與 detail 設定。
+    str() 為 base64 字串，可直接用在原本接受 image_base64 的地方。
+    """
+    def __init__(self, base64_str:str, detail:str='auto', width:int=0, height:int=0, quality:int=0, tokens:int=0):
+        self.base64 = base64_str
+        self.detail = detail
+        self.width = width
+        self.height = height
+        self.quality = quality
+        self.tokens = tokens
+
+    @property
+    def num_bytes(self)->int:
+        return len(self.base64)
+
+    def __str__(self):
+        return self.base64
+
+def encode_image(img:np.ndarray, max_edge:int=512, max_bytes:int=80*1024, token_budget:int=None,
+                 detail:str='auto', quality:int=85, min_quality:int=MIN_JPEG_QUALITY, min_edge:int=128,
+                 model:str='gpt-4o-mini')->ImagePayload:
+    """
+    依設定的位元組與 token 上限編碼圖片：
+    先把長邊縮到 max_edge 以內（不放大）；超過 token_budget 時改用 detail=low；
+    接著從 quality 開始逐步降低 JPEG 品質，直到 base64 後的大小不超過 max_bytes，
+    降到 min_quality 仍太大時再縮小尺寸。
+    """
+    if detail == 'low':
+        max_edge = min(max_edge, 512)  # low detail 時 API 一律以 512x512 處理，傳更大的圖沒有意義
+    # 從 quality 開始每次降 10，最後一定會試到 min_quality；quality 低於下限時只用 min_quality
+    qualities = sorted({*range(max(quality, min_quality), min_quality, -10), min_quality}, reverse=True)
+    height, width = img.shape[:2]
+    edge = min(max_edge, max(width, height))
+    if detail == 'auto' and token_budget is not None:
+        scale = edge / max(width, height)
+        if estimate_image_tokens(width * scale, height * scale, 'high', model) > token_budget:
+            detail = 'low'
+            edge = min(edge, 512)
+    while True:
+        scale = edge / max(width, height)
+        resized = img if scale >= 1 else cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))),
+                                                    interpolation=cv2.INTER_AREA)
+        for q in qualities:
+            _, img_encode = cv2.imencode('.jpg', resized, [cv2.IMWRITE_JPEG_QUALITY, q])
+            img_base64 = base64.b64encode(img_encode).decode()
+            if len(img_base64) <= max_bytes:
+                break
+        if len(img_base64) <= max_bytes or edge <= min_edge:
+            break
+        edge = max(min_edge, int(edge * 0.75))
+    h, w = resized.shape[:2]
+    tokens = estimate_image_tokens(w, h, detail, model)
+    payload = ImagePayload(img_base64, detail, w, h, q, tokens)
+    log_and_print(f"Image payload: {w}x{h}, quality {q}, {payload.num_bytes} bytes, detail {detail}, ~{tokens} tokens", 'info')
+    return payload
+
+def build_request(image_base64:str, instruction:str, max_tokens:int=300)->dict:
     payload = {
         "model": "gpt-4o-mini",
         "messages": [
@@ -40,40 +118,131 @@ def call_api(image_base64:str, instruction:str):
                     {
                     "type": "image_url",
                     "image_url": {
-                        "url": f"data:image/jpeg;base64,{image_base64}"
+                        "url": f"data:image/jpeg;base64,{image_base64}",
+                        "detail": getattr(image_base64, 'detail', 'auto')
                     }
                     }
                 ]
             }
         ],
-        "max_tokens": 300
+        "max_tokens": max_tokens
     }
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
+    return payload
+
+def call_api(image_base64:str, instruction:str, max_tokens:int=300, json_mode:bool=False):
+    payload = build_request(image_base64, instruction, max_tokens)
+    if json_mode:
+        payload["response_format"] = {"type": "json_object"}
+    # 共用的連線池 session，含 timeout 與 429/5xx 重試；失敗時拋出 http_utils.APIError
+    response = http_utils.post("/chat/completions", payload)
     # response should be like this:
     # {'id': 'chatcmpl-A0VHAXDKnKTHq6r7AgV27Jow2IAzH', 'object': 'chat.completion', 'created': 1724683588, 'model': 'gpt-4o-mini-2024-07-18', 'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': '作品名稱：生活的滋味\n\n這件藝術品運用日常食品作為創作主題，探索飲食文化與情感的交織。透過一碗看似平常的飯食，作品傳達了對家庭、友情與回憶的珍視。此外，藝術家意圖喚起觀者的共鳴，使人們反思在快節奏的現代生活中，飲食不僅是一種生理需求，更是一種文化交流與情感聯繫的媒介。每一口飯食皆是生活的縮影，富含深刻的意義。', 'refusal': None}, 'logprobs': None, 'finish_reason': 'stop'}], 'usage': {'prompt_tokens': 8534, 'completion_tokens': 139, 'total_tokens': 8673}, 'system_fingerprint': 'fp_507c9469a1'}
     res = response.json()
     if 'choices' not in res:
-        log_and_print(f'In gpt_utils.py, call_api function, response: {res}', 'DEBUG')
-        quit()
+        log_and_print(f'In gpt_utils.py, call_api function, response: {res}', 'debug')
+        raise APIResponseError("Response has no choices", response.status_code, res)
     return res['choices'][0]['message']['content']
 
+def call_api_stream(image_base64:str, instruction:str, max_tokens:int=300):
+    """以 stream 模式呼叫 API，逐段 yield 模型產生的文字。"""
+    payload = build_request(image_base64, instruction, max_tokens)
+    payload["stream"] = True
+    with http_utils.post("/chat/completions", payload, stream=True) as response:
+        # server-sent events，每一行為 "data: {...}"，結尾為 "data: [DONE]"
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                break
+            choices = json.loads(data).get('choices') or []
+            if choices:
+                delta = choices[0].get('delta', {}).get('content')
+                if delta:
+                    yield delta
+
+# 中文句尾直接斷句；英文句點等需後面接空白才斷句，避免切到小數點或縮寫
+sentence_end = re.compile(r'[。！？；!?\n]+[」』”"）)]*|[.]+[」』”"）)]*(?=\s)')
+
+def split_sentences(chunks, min_chars:int=6):
+    """
+    把串流文字依句子切開，每湊齊一句就 yield，讓 TTS 可以先處理前面的句子。
+    少於 min_chars 的片段會併入下一句，避免產生過短的音檔。
+    """
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        start = 0
+        for match in sentence_end.finditer(buffer):
+            if len(buffer[start:match.end()].strip()) < min_chars:
+                continue
+            sentence = buffer[start:match.end()].strip()
+            start = match.end()
+            yield sentence
+        buffer = buffer[start:]
+    if buffer.strip():
+        yield buffer.strip()
+
+def describe_instruction(text_num:int=50):
+    return f"請想像你是直接看見，並以{str(text_num)}字繁體中文描述這個物品。最後加上英文翻譯。"
+
+def is_art_instruction(text_num:int=100):
+    reference = "介紹時請參考（但不一定要提及）以下關鍵字：觀念藝術、 現成物、雕塑、藝術品、勞動、存在主義、解構主義。可參考（但不一定要提及）當代藝術家如杜象、波伊斯等的作品創作理念。"
+    return f"你是一個這個藝術品的作者，請想像你是直接看見這個放在展台上的藝術品，首先先介紹它的藝術作品名，並以{str(text_num)}字繁體中文向10歲小孩介紹這個作品。接著說說這個作品背後的故事。最後做一個簡單的英文總結。"
+
+def not_art_instruction(text_num:int=100):
+    reference = "介紹時請參考（但不一定要提及）以下關鍵字：觀念藝術、 現成物、雕塑、藝術品、勞動、存在主義、解構主義。可參考（但不一定要提及）當代藝術家如杜象、波伊斯等的作品創作理念。"
+    return f"請想像你是直接看見，請以{str(text_num)}字以內的繁體中文告訴我為何這個這個放在展台上的東西不是一個藝術作品。{reference}最後加上英文翻譯。"
+
+instruction_mapping = {
+    'describe': describe_instruction,
+    'isart': is_art_instruction,
+    'notart': not_art_instruction,
+}
+
 def describe_iamge(image_base64:str, text_num:int=50):
-    instruct = f"請想像你是直接看見，並以{str(text_num)}字繁體中文描述這個物品。最後加上英文翻譯。"
-    result = call_api(image_base64, instruct)
+    result = call_api(image_base64, describe_instruction(text_num))
     return result
 
 def is_art(image_base64:str, text_num:int=100):
-    reference = "介紹時請參考（但不一定要提及）以下關鍵字：觀念藝術、 現成物、雕塑、藝術品、勞動、存在主義、解構主義。可參考（但不一定要提及）當代藝術家如杜象、波伊斯等的作品創作理念。"
-    instruct = f"你是一個這個藝術品的作者，請想像你是直接看見這個放在展台上的藝術品，首先先介紹它的藝術作品名，並以{str(text_num)}字繁體中文向10歲小孩介紹這個作品。接著說說這個作品背後的故事。最後做一個簡單的英文總結。"
-    result = call_api(image_base64, instruct)
+    result = call_api(image_base64, is_art_instruction(text_num))
     return result
 
 def not_art(image_base64:str, text_num:int=100):
-    reference = "介紹時請參考（但不一定要提及）以下關鍵字：觀念藝術、 現成物、雕塑、藝術品、勞動、存在主義、解構主義。可參考（但不一定要提及）當代藝術家如杜象、波伊斯等的作品創作理念。"
-    instruct = f"請想像你是直接看見，請以{str(text_num)}字以內的繁體中文告訴我為何這個這個放在展台上的東西不是一個藝術作品。{reference}最後加上英文翻譯。"
-    result = call_api(image_base64, instruct)
+    result = call_api(image_base64, not_art_instruction(text_num))
     return result
 
+def combined_instruction(types:list, text_num:int):
+    tasks = "\n".join(f'- "{type}": {instruction_mapping[type](text_num)}' for type in types)
+    keys = ", ".join(f'"{type}"' for type in types)
+    return (f"請看這張圖片，分別完成以下每一項任務，各項任務彼此獨立。\n{tasks}\n"
+            f"請只回覆一個 JSON 物件，key 為 {keys}，value 為該項任務的完整回答文字。")
+
+def generate_texts(image_base64:str, types:list, text_num:int=100, combined:bool=True):
+    """
+    產生 types 中每一種文字，回傳 {type: text}。
+    combined 為 True 且有多種文字時，只上傳一次圖片，以 JSON 模式一次取得所有結果；
+    JSON 解析失敗或缺少欄位時，缺少的部分改用單獨呼叫補上。
+    """
+    types = list(dict.fromkeys(types))
+    for type in types:
+        if type not in instruction_mapping:
+            log_and_print(f"type must be one of {list(instruction_mapping)}", 'error')
+            raise ValueError(f"type must be one of {list(instruction_mapping)}")
+    texts = {}
+    if combined and len(types) > 1:
+        content = call_api(image_base64, combined_instruction(types, text_num),
+                           max_tokens=300 * len(types), json_mode=True)
+        try:
+            result = json.loads(content)
+            texts = {type: result[type] for type in types if isinstance(result.get(type), str) and result[type]}
+        except (json.JSONDecodeError, AttributeError) as e:
+            log_and_print(f'In gpt_utils.py, generate_texts failed to parse JSON: {e}, content: {content}', 'warning')
+    for type in types:
+        if type not in texts:
+            texts[type] = call_api(image_base64, instruction_mapping[type](text_num))
+    return texts
+
 if __name__ == "__main__":
     # logname = 'log_gpt_utils'
     # logging.basicConfig(
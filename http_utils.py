@@ -0,0 +1,94 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import KEYS
+from utils import log_and_print
+
+API_BASE_URL = "https://api.openai.com/v1"
+# (connect, read) 秒；read timeout 是兩段資料之間的最長等待時間，串流時不會因為總長度而逾時
+DEFAULT_TIMEOUT = (3.05, 30)
+
+
+class APIError(Exception):
+    """OpenAI API 呼叫失敗的基底類別。"""
+
+
+class APITimeoutError(APIError):
+    """連線或讀取逾時。"""
+
+
+class APIConnectionError(APIError):
+    """無法建立連線（重試後仍失敗）。"""
+
+
+class APIResponseError(APIError):
+    """API 回應非 200 或內容不符合預期。"""
+
+    def __init__(self, message, status_code=None, body=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+
+
+session = None
+session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    取得共用的 requests.Session（gpt_utils 與 TTS_utils 共用），
+    保持連線池與 keep-alive，避免每次觸發都重新做 TCP + TLS handshake。
+    """
+    global session
+    with session_lock:
+        if session is None:
+            retry = Retry(
+                total=3,
+                connect=3,
+                read=0,  # 請求已送出後的讀取錯誤不重試，避免重複計費
+                status=3,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=None,  # POST 也重試（429/5xx 代表請求沒有被處理）
+                backoff_factor=0.5,
+                backoff_jitter=0.5,
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+            new_session = requests.Session()
+            new_session.mount("https://", adapter)
+            new_session.headers.update({"Authorization": f'Bearer {KEYS.OPENAI_KEY}'})
+            session = new_session
+        return session
+
+
+def post(path, payload, stream=False, timeout=DEFAULT_TIMEOUT):
+    """
+    POST 到 API，失敗時拋出 APIError 的子類別；回傳 status 200 的 response。
+    stream=True 時呼叫端需自行關閉 response（建議用 with）。
+    """
+    try:
+        response = get_session().post(f"{API_BASE_URL}{path}", json=payload, stream=stream, timeout=timeout)
+    except requests.exceptions.Timeout as e:
+        raise APITimeoutError(f"Request to {path} timed out: {e}") from e
+    except requests.exceptions.ConnectionError as e:
+        raise APIConnectionError(f"Connection to {path} failed: {e}") from e
+    except requests.exceptions.RequestException as e:
+        raise APIError(f"Request to {path} failed: {e}") from e
+    if response.status_code != 200:
+        body = response.text
+        response.close()
+        raise APIResponseError(f"Request to {path} returned {response.status_code}", response.status_code, body)
+    return response
+
+
+def warm_up():
+    """在背景先建立連線，第一次觸發時就不用等 handshake。"""
+    def _warm_up():
+        try:
+            get_session().get(f"{API_BASE_URL}/models", timeout=DEFAULT_TIMEOUT).close()
+            log_and_print("API connection warmed up.", 'info')
+        except requests.exceptions.RequestException as e:
+            log_and_print(f"API warm up failed: {e}", 'warning')
+    threading.Thread(target=_warm_up, daemon=True).start()
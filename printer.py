@@ -1,6 +1,9 @@
 import serial
 import adafruit_thermal_printer
 import threading
+import itertools
+import queue
+import collections
 from PIL import Image, ImageOps, ImageDraw, ImageFont
 import time
 
@@ -37,7 +40,77 @@ class ThermalPrinterManager:
         with printer_lock:
             self.printer.test_page()
             self.printer.feed(5)
-    
+
+    def write_paced(self, data, chunk_size=64, bytes_per_second=400):
+        """分段寫入已編碼的資料，每段之後等待印表機印完，避免緩衝區溢出"""
+        with printer_lock:
+            for start in range(0, len(data), chunk_size):
+                chunk = data[start:start + chunk_size]
+                self.printer._uart.write(chunk)
+                time.sleep(len(chunk) / bytes_per_second)
+            self.printer.feed(5)
+
+
+class SpoolerFullError(Exception):
+    """工作佇列已滿。"""
+
+
+class PrinterSpooler:
+    """
+    印表機工作佇列：submit 立即回傳 job id，背景執行緒依序列印，送出端不必等待印完。
+    文字分段寫入 UART，依印表機實際的列印速度（bytes_per_second）控制寫入節奏，
+    避免印表機的緩衝區溢出，前後工作也能連續列印。
+    """
+
+    def __init__(self, manager, max_jobs=16, bytes_per_second=400, chunk_size=64, history=100):
+        self.manager = manager
+        self.bytes_per_second = bytes_per_second
+        self.chunk_size = chunk_size
+        self.history = history
+        self.jobs = queue.Queue(maxsize=max_jobs)
+        self.status = collections.OrderedDict()  # {job id: 狀態 dict}
+        self.status_lock = threading.Lock()
+        self.job_ids = itertools.count(1)
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def submit(self, text):
+        """加入工作佇列並回傳 job id；無法以 GBK 編碼時拋出 UnicodeEncodeError，佇列已滿時拋出 SpoolerFullError。"""
+        encoded_text = text.encode('gbk')  # 轉換為 GBK 編碼；無法編碼時直接在這裡拋出，呼叫端可回報錯誤
+        job_id = next(self.job_ids)
+        with self.status_lock:
+            self.status[job_id] = {'state': 'queued', 'chars': len(text), 'bytes': len(encoded_text), 'submitted': time.time()}
+            # 只保留最近 history 筆狀態
+            while len(self.status) > self.history:
+                self.status.popitem(last=False)
+        try:
+            self.jobs.put_nowait((job_id, encoded_text))
+        except queue.Full:
+            self._update(job_id, state='rejected')
+            raise SpoolerFullError(f"printer queue full ({self.jobs.maxsize} jobs)")
+        return job_id
+
+    def job_status(self, job_id):
+        with self.status_lock:
+            status = self.status.get(job_id)
+            return dict(status, queue_length=self.jobs.qsize()) if status is not None else None
+
+    def _update(self, job_id, **fields):
+        with self.status_lock:
+            if job_id in self.status:
+                self.status[job_id].update(fields)
+
+    def _worker(self):
+        while True:
+            job_id, data = self.jobs.get()
+            self._update(job_id, state='printing', started=time.time())
+            try:
+                self.manager.write_paced(data, self.chunk_size, self.bytes_per_second)
+                self._update(job_id, state='done', finished=time.time())
+            except Exception as e:
+                self._update(job_id, state='failed', finished=time.time(), error=str(e))
+
+
 if __name__ == "__main__":
     printer_manager = ThermalPrinterManager()  # 只有第一次執行時才初始化
     printer_manager.print_text("您好，歡迎使用熱感印表機！這是繁體中文不是簡體中文國字國字")
\ No newline at end of file
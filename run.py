@@ -2,14 +2,20 @@ import gpt_utils
 from KEYS import OPENAI_KEY
 import sound
 import TTS_utils
+import http_utils
+import cache_utils
 import os
 import cv2
 import time
 import numpy as np
 import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, Future
 import argparse
-from web_socket import MacSocket, PiSocket
+from web_socket import MacSocket, PiSocket, DeviceConnectionPool, DeviceUnavailableError
+from device_registry import DeviceRegistry
 from utils import log_and_print
+from vision_utils import MJPEGStreamParser, EncodedFrame, PreprocessEngine, create_background_model, BACKGROUND_MODELS
 import logging
 from datetime import datetime
 import subprocess
@@ -26,7 +32,7 @@ class DSLRCapture:
         self.apply_settings('camera_config.json')
         self.process = subprocess.Popen(['gphoto2', '--capture-movie', '--stdout'],
                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        self.buffer = b""
+        self.parser = MJPEGStreamParser()
 
     def set_camera_setting(self, setting, value):
         try:
@@ -73,27 +79,30 @@ class DSLRCapture:
         self.set_camera_setting('shutterspeed', str(self.shutter_speed_values))
         print(f"Apply with settings - ISO: {self.iso_values}, Aperture: {self.aperture_values}, Shutter Speed: {self.shutter_speed_values}")
 
-    def read(self):
-        # 內部循環最多等待 5 秒，嘗試取得一張完整的 JPEG 影像
+    def read_encoded(self):
+        # 內部循環最多等待 5 秒，嘗試取得一張完整的 JPEG 影像（不解碼）
         start_time = time.time()
         timeout = 5.0
         while time.time() - start_time < timeout:
             rlist, _, _ = select.select([self.process.stdout], [], [], 0.1)
-            if self.process.stdout in rlist:
-                data = self.process.stdout.read(4096)
-                if data:
-                    self.buffer += data
-                start_idx = self.buffer.find(b'\xff\xd8')
-                end_idx = self.buffer.find(b'\xff\xd9')
-                if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
-                    end_idx += 2
-                    jpg = self.buffer[start_idx:end_idx]
-                    self.buffer = self.buffer[end_idx:]
-                    frame = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_COLOR)
-                    if frame is not None:
-                        return True, frame
-            else:
-                time.sleep(0.1)
+            if self.process.stdout not in rlist:
+                continue
+            # 把目前 pipe 中可讀的資料一次讀完，只保留最新的一張，舊影像直接略過
+            while self.process.stdout in rlist:
+                if not self.parser.feed_from(self.process.stdout):
+                    break
+                rlist, _, _ = select.select([self.process.stdout], [], [], 0)
+            jpg = self.parser.pop_latest()
+            if jpg is not None:
+                return True, jpg
+        return False, None
+
+    def read(self):
+        ret, jpg = self.read_encoded()
+        if ret:
+            frame = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if frame is not None:
+                return True, frame
         return False, None
     
     def isOpened(self):
@@ -109,40 +118,119 @@ class DSLRCapture:
 
 # FrameGrabber 類別：持續讀取最新影像（適用於 DSLRCapture 或 cv2.VideoCapture）
 class FrameGrabber:
-    def __init__(self, cap):
+    def __init__(self, cap, gray_reduce=4):
         self.cap = cap
+        self.gray_reduce = gray_reduce
         self.latest_frame = None
+        self.seq = 0  # 每發佈一張新影像就加一
+        self.min_interval = 0  # 兩次發佈影像之間的最短間隔（秒），由 RateGovernor 調整
+        self.last_publish_time = 0
         self.running = True
         self.lock = threading.Lock()
+        self.new_frame = threading.Condition(self.lock)
         self.thread = threading.Thread(target=self.grab_frames, daemon=True)
         self.thread.start()
         
+    def set_min_interval(self, interval):
+        self.min_interval = interval
+
     def grab_frames(self):
         while self.running:
-            # 針對 cap 類型，呼叫 read() 方法
-            ret_frame = self.cap.read()
-            # 如果是 cv2.VideoCapture，read() 返回 (ret, frame)
-            if isinstance(ret_frame, tuple):
-                ret, frame = ret_frame
+            # 還沒到下一次發佈的時間：仍要把相機的資料讀掉以保持最新，但不解碼也不發佈
+            skip = time.time() - self.last_publish_time < self.min_interval
+            # DSLRCapture 只取原始 JPEG，等需要時才解碼
+            if hasattr(self.cap, 'read_encoded'):
+                ret, jpg = self.cap.read_encoded()
+                if skip:
+                    continue
+                frame = EncodedFrame(jpg=jpg, gray_reduce=self.gray_reduce) if ret else None
+            elif skip and hasattr(self.cap, 'grab'):
+                # cv2.VideoCapture.grab() 只取影像不解碼
+                if not self.cap.grab():
+                    time.sleep(0.01)
+                continue
             else:
-                ret, frame = ret_frame, None  # 這裡通常不會發生
+                # 如果是 cv2.VideoCapture，read() 返回 (ret, frame)
+                ret_frame = self.cap.read()
+                if isinstance(ret_frame, tuple):
+                    ret, image = ret_frame
+                else:
+                    ret, image = ret_frame, None  # 這裡通常不會發生
+                frame = EncodedFrame(image=image) if ret and image is not None else None
             if ret and frame is not None:
-                with self.lock:
+                with self.new_frame:
+                    self.seq += 1
+                    frame.seq = self.seq
                     self.latest_frame = frame
-            time.sleep(0.01)
+                    self.last_publish_time = time.time()
+                    self.new_frame.notify_all()
+            else:
+                # 讀取失敗時稍等一下，避免空轉（成功時 read 本身就會阻塞到下一張影像）
+                time.sleep(0.01)
             
     def get_frame(self):
         with self.lock:
             return self.latest_frame
+
+    def wait_for_frame(self, last_seq, timeout=None):
+        """
+        阻塞直到有比 last_seq 更新的影像，回傳 (seq, frame)；逾時則回傳 (last_seq, None)。
+        """
+        with self.new_frame:
+            if not self.new_frame.wait_for(lambda: self.seq > last_seq or not self.running, timeout=timeout):
+                return last_seq, None
+            if self.seq <= last_seq:
+                return last_seq, None
+            return self.seq, self.latest_frame
         
     def stop(self):
-        self.running = False
+        with self.new_frame:
+            self.running = False
+            self.new_frame.notify_all()
         self.thread.join()
 
+# RateGovernor 類別：依偵測狀態決定每秒要處理幾張影像
+class RateGovernor:
+    def __init__(self, frame_budget=None, boost_hold=3.0):
+        # 每個狀態每秒處理的影像數，0 表示不限制（相機能給多快就處理多快）
+        self.frame_budget = {'IDLE': 4, 'CHANGE': 0, 'DETECTED': 2}
+        if frame_budget:
+            self.frame_budget.update(frame_budget)
+        # coarse 層級一偵測到變化就立即全速，並維持 boost_hold 秒
+        self.boost_hold = boost_hold
+        self.last_change_time = 0
+
+    def interval_for(self, state, coarse_change):
+        """回傳下一張影像前應等待的最短間隔（秒）。"""
+        now = time.time()
+        if coarse_change:
+            self.last_change_time = now
+        if now - self.last_change_time < self.boost_hold:
+            return 0
+        fps = self.frame_budget.get(state, 0)
+        return 1 / fps if fps > 0 else 0
+
+    @staticmethod
+    def parse_budget(budget_str):
+        """解析 'IDLE=4,CHANGE=0,DETECTED=2' 格式的設定。"""
+        budget = {}
+        for item in budget_str.split(','):
+            if not item.strip():
+                continue
+            state, fps = item.split('=')
+            state = state.strip().upper()
+            if state not in ('IDLE', 'CHANGE', 'DETECTED'):
+                raise ValueError(f"Unknown state in frame budget: {state}")
+            budget[state] = float(fps)
+        return budget
+
 # MotionDetector 類別
 class MotionDetector:
     def __init__(self, cap, background_path="background.jpg", detect_interval=0.5, text_num=50, zoom=0, 
-                 audio_detach=False, audio_playlist=['isart', 'notart', 'describe'], printer_detach=False, printer_list=[], high_sync=False):
+                 audio_detach=False, audio_playlist=['isart', 'notart', 'describe'], printer_detach=False, printer_list=[], high_sync=False,
+                 gray_reduce=4, background_model='static', background_alpha=0.02, background_update_interval=1.0,
+                 frame_budget=None, single_request=True, pipeline_workers=4, stream_audio=False,
+                 content_cache=None, image_budget=None, device_pool=None, device_registry=None, device_timeout=1.0):
         self.cap = cap
         if hasattr(self.cap, "isOpened"):
             if not self.cap.isOpened():
@@ -158,25 +246,62 @@ class MotionDetector:
 
         self.printer_detach = printer_detach
         self.printer_list = printer_list
+        self.printer_manager = None
+        if self.printer_list and not self.printer_detach:
+            # 本機列印：printer 模組需要序列埠相關套件，只有在本機接印表機時才載入
+            import printer
+            self.printer_manager = printer.ThermalPrinterManager()
 
         if len(self.audio_playlist) == 0 and len(self.printer_list) == 0:
             log_and_print("No action specified", 'error')
             raise ValueError("No action specified")
 
         self.resized_shape = (224, 224)
+        self.engine = PreprocessEngine(zoom=self.zoom, resized_shape=self.resized_shape)
+        # 背景模型只在 IDLE 狀態下、每 background_update_interval 秒更新一次
+        self.background_model = create_background_model(background_model, self.engine, background_alpha)
+        self.background_update_interval = background_update_interval
+        self.last_background_update = time.time()
+        self.governor = RateGovernor(frame_budget)
         # 建立 frame grabber 以持續取得最新影像
-        self.frame_grabber = FrameGrabber(self.cap)
+        self.frame_grabber = FrameGrabber(self.cap, gray_reduce=gray_reduce)
         self.background = self.initialize_background()
         self.state = "IDLE"
         self.last_frame = None
         self.text_num = text_num
         self.intro_sound_path = r'intro_alloy.mp3'
+        if self.audio_playlist and not self.audio_detach:
+            # 開場音效解碼後常駐記憶體，觸發時立即播放
+            sound.preload(self.intro_sound_path)
+        self.intro_audio = None
+        if self.audio_playlist and self.audio_detach:
+            # 開場音效只讀一次；裝置上已有時只會傳送 hash
+            with open(self.intro_sound_path, 'rb') as f:
+                self.intro_audio = f.read()
         self.high_sync = high_sync
+        self.single_request = single_request
+        self.stream_audio = stream_audio
+        # perceptual hash 快取（cache_utils.PerceptualCache），None 表示不使用
+        self.content_cache = content_cache
+        # gpt_utils.encode_image 的參數（max_edge、max_bytes、token_budget、detail、quality）
+        self.image_budget = image_budget or {}
+        # 到各台 Pi 的常駐連線（web_socket.DeviceConnectionPool），None 表示每次重新連線
+        self.device_pool = device_pool
+        # UDP 探索與健康檢查（device_registry.DeviceRegistry），None 表示使用 device_ip 中的固定位址
+        self.device_registry = device_registry
+        self.device_timeout = device_timeout
+        # GPT/TTS 的 worker pool，同時處理 playlist 中的各個項目
+        self.executor = ThreadPoolExecutor(max_workers=pipeline_workers)
+        # 目前載入前處理引擎的 frame seq，同一 tick 內的多次 compare 共用前處理結果
+        self.processed_seq = None
+        self.coarse_change = False
         # 定義一個差異容許值，低於此值即視為「無變化」
         self.diff_threshold = self.resized_shape[0] * self.resized_shape[1] * 0.05
+        # diff 為 0/255 的二值圖，原本 np.sum(diff) 與 diff_threshold 比較，等同於像素數與 diff_threshold / 255 比較
+        self.diff_pixel_threshold = self.diff_threshold / 255
 
     def center_crop(self, img, gray_resize_blur=False):
-        img = np.array(img)
+        img = np.asarray(img)
         height, width = img.shape[:2]
         new_width = min(width, height)
         left, top = (width - new_width) // 2, (height - new_width) // 2
@@ -204,81 +329,132 @@ class MotionDetector:
             log_and_print("Waiting for DSLR live view to stabilize...", "info")
             time.sleep(5)
         attempts = 0
-        frame = self.frame_grabber.get_frame()
-        while frame is None and attempts < 20:
+        seq, frame = self.frame_grabber.wait_for_frame(0, timeout=0.2)
+        while (frame is None or frame.motion_image() is None) and attempts < 20:
             log_and_print(f"Attempt {attempts+1}: No background frame available. Retrying...", "info")
-            time.sleep(0.2)
-            frame = self.frame_grabber.get_frame()
+            seq, frame = self.frame_grabber.wait_for_frame(seq, timeout=0.2)
             attempts += 1
-        if frame is None:
+        if frame is None or frame.motion_image() is None:
             log_and_print("Failed to capture image from camera.", "error")
             raise RuntimeError("Failed to capture image from camera.")
-        frame = self.center_crop(frame, gray_resize_blur=True)
-        cv2.imwrite(self.background_path, frame)
+        self.engine.load(frame.motion_image())
+        background = self.background_model.initialize()
+        cv2.imwrite(self.background_path, background.fine)
         log_and_print("Background captured successfully.", "info")
-        return frame
+        return background
+
+    def preprocess(self, frame):
+        """
+        把影像載入前處理引擎，每張影像（以 seq 區分）只載入一次；
+        coarse/fine 結果由引擎在需要時計算並在同一 tick 內共用。
+        """
+        if frame.seq is not None and self.processed_seq == frame.seq:
+            return
+        # motion 偵測只用縮小的灰階影像（或直接使用已解碼的影像），彩色影像留給 trigger_action 需要時再解碼
+        self.engine.load(frame.motion_image())
+        self.processed_seq = frame.seq
 
-    def compare(self, baseline):
-        frame = self.frame_grabber.get_frame()
-        if frame is None:
+    def compare(self, baseline, frame):
+        if frame is None or frame.motion_image() is None:
             log_and_print("No frame available.", 'error')
-            return None, None, None, 0
-        processed_img = self.center_crop(frame, gray_resize_blur=True)
-        diff = cv2.absdiff(baseline, processed_img)
-        _, diff = cv2.threshold(diff, 50, 255, cv2.THRESH_BINARY)
+            return None, None, 0
+        self.preprocess(frame)
+        # coarse-to-fine：低解析度沒有變化就不計算 224x224 的 fine 層級，有變化時以 fine 層級確認
+        changed, coarse_changed = self.engine.cascade_changed_pixels(baseline)
+        self.coarse_change = self.coarse_change or coarse_changed
         current_time = time.time()
-        return diff, processed_img, frame, current_time - self.last_detect_time
+        return changed, frame, current_time - self.last_detect_time
 
-    def state_machine(self):
+    def update_last_frame(self):
+        # 複製到固定的 last_frame 緩衝區，引擎的輸出緩衝區下一張影像就會被覆寫
+        self.last_frame = self.engine.snapshot(into=self.last_frame)
+
+    def state_machine(self, frame_data):
         start = time.time()
+        self.coarse_change = False
         if self.state == "IDLE":
-            diff, frame, image, interval = self.compare(self.background)
-            if diff is not None and np.sum(diff) > 0 and interval > self.detect_interval:
+            diff, image, interval = self.compare(self.background, frame_data)
+            if diff is not None and diff > 0 and interval > self.detect_interval:
                 self.state = "CHANGE"
                 self.last_detect_time = time.time()
-                self.last_frame = frame
+                self.update_last_frame()
+            elif diff == 0 and time.time() - self.last_background_update > self.background_update_interval:
+                # 仍在 IDLE 且畫面與背景一致：讓背景模型慢慢適應光線變化（background 與模型共用同一組緩衝區）
+                # 冷卻時間內出現的變化不更新，避免放上的物品被融入背景而永遠不觸發
+                self.background_model.update()
+                self.last_background_update = time.time()
         elif self.state == "CHANGE":
-            last_frame_diff, last_frame, last_image, last_frame_interval = self.compare(self.last_frame)
-            background_diff, background_frame, background_image, background_interval = self.compare(self.background)
-            if background_diff is not None and np.sum(background_diff) == 0 and background_interval > self.detect_interval:
+            last_frame_diff, last_image, last_frame_interval = self.compare(self.last_frame, frame_data)
+            background_diff, background_image, background_interval = self.compare(self.background, frame_data)
+            if background_diff is not None and background_diff == 0 and background_interval > self.detect_interval:
                 self.state = "IDLE"
                 self.last_detect_time = time.time()
             # 將判定條件改為低於 diff_threshold 而非完全等於 0
-            elif last_frame_diff is not None and np.sum(last_frame_diff) < self.diff_threshold and last_frame_interval > self.detect_interval:
+            elif last_frame_diff is not None and last_frame_diff < self.diff_pixel_threshold and last_frame_interval > self.detect_interval:
                 self.state = "DETECTED"
                 threading.Thread(target=self.trigger_action, args=(last_image,)).start()
                 self.last_detect_time = time.time()
-            elif last_frame_diff is not None and np.sum(last_frame_diff) >= self.diff_threshold and last_frame_interval > self.detect_interval:
+            elif last_frame_diff is not None and last_frame_diff >= self.diff_pixel_threshold and last_frame_interval > self.detect_interval:
                 self.state = "CHANGE"
                 self.last_detect_time = time.time()
-                self.last_frame = last_frame
+                self.update_last_frame()
         elif self.state == "DETECTED":
-            diff, frame, image, interval = self.compare(self.last_frame)
+            diff, image, interval = self.compare(self.last_frame, frame_data)
             # 同樣使用 diff_threshold 判定
-            if diff is not None and np.sum(diff) < self.diff_threshold and interval > self.detect_interval:
+            if diff is not None and diff < self.diff_pixel_threshold and interval > self.detect_interval:
                 self.state = "DETECTED"
                 self.last_detect_time = time.time()
-            elif diff is not None and np.sum(diff) >= self.diff_threshold and interval > self.detect_interval:
+            elif diff is not None and diff >= self.diff_pixel_threshold and interval > self.detect_interval:
                 self.state = "CHANGE"
                 self.last_detect_time = time.time()
-                self.last_frame = frame
+                self.update_last_frame()
         end = time.time()
         print(self.state, round(1 / (end - start), 4), end='\r')
 
-    def socket_playaudio(self, type, audio_path):
+    def device_request(self, pi_name, action):
+        """
+        在 pi_name 的連線上執行 action(MacSocket)。
+        device_registry 判定離線的裝置直接拋出 DeviceUnavailableError，不嘗試連線；
+        有 device_pool 時使用常駐連線，否則每次建立新連線，用完關閉。
+        """
+        if self.device_registry is not None and not self.device_registry.healthy(pi_name):
+            raise DeviceUnavailableError(f"[{pi_name}] not responding to discovery")
+        if self.device_pool is not None:
+            return self.device_pool.request(pi_name, action)
+        address = self.device_registry.address(pi_name) if self.device_registry is not None else None
+        try:
+            # 與 device_pool 相同的回應期限，裝置接受連線卻不回覆時不會一直等待
+            socket = MacSocket(pi_name, connect_timeout=self.device_timeout, timeout=self.device_timeout * 3,
+                               address=address)
+        except OSError as e:
+            raise DeviceUnavailableError(f"[{pi_name}] {e}") from e
         try:
-            socket = MacSocket(type)
-            socket.send_file(audio_path)
+            return action(socket)
+        except OSError as e:
+            raise DeviceUnavailableError(f"[{pi_name}] {e}") from e
+        finally:
             socket.end_connection()
+
+    def socket_playaudio(self, type, audio):
+        try:
+            # audio 可以是音檔路徑或記憶體中的 bytes
+            if isinstance(audio, (bytes, bytearray)):
+                self.device_request(type, lambda socket: socket.send_bytes(audio))
+            else:
+                self.device_request(type, lambda socket: socket.send_file(audio))
+        except DeviceUnavailableError as e:
+            # 裝置離線時改在本機播放（排在目前的播放之後）
+            log_and_print(f"Device unavailable, playing {type} locally: {e}", 'warning')
+            sound.enqueue_mp3(audio)
         except:
             log_and_print("Socket connection failed for audio", 'error')
             raise RuntimeError("Socket connection failed for audio")
         
     def socket_printtext(self, printer_name, text):
         try:
-            socket = MacSocket(printer_name)
-            socket.send_printer_text(text)
-            socket.end_connection()
+            return self.device_request(printer_name, lambda socket: socket.send_printer_text(text))
+        except DeviceUnavailableError as e:
+            log_and_print(f"Skip printing, device unavailable: {e}", 'warning')
         except:
             log_and_print("Socket connection failed for printer", 'error')
             raise RuntimeError("Socket connection failed for printer")
@@ -286,89 +462,295 @@ class MotionDetector:
     def socket_playintro(self):
         try:
             time.sleep(1)
-            socket = MacSocket(self.audio_playlist[0])
-            socket.send_msg("play_intro")
-            socket.end_connection()
+            self.device_request(self.audio_playlist[0], lambda socket: socket.send_bytes(self.intro_audio))
+        except DeviceUnavailableError as e:
+            log_and_print(f"Device unavailable, playing intro locally: {e}", 'warning')
+            sound.play_mp3_threaded(self.intro_sound_path)
         except:
             log_and_print("Socket connection failed for intro", 'error')
             raise RuntimeError("Socket connection failed for intro")
 
-    def image_to_audio(self, base64_image, type):
-        type_mapping = {
-            'describe': (lambda img: gpt_utils.describe_iamge(img, text_num=self.text_num), 'describe'),
-            'isart': (lambda img: gpt_utils.is_art(img, text_num=self.text_num), 'isart'),
-            'notart': (lambda img: gpt_utils.not_art(img, text_num=self.text_num), 'notart')
-        }
-        if type not in type_mapping:
+    def generate_texts(self, base64_image, types):
+        # 多種文字時只上傳一次圖片，一次取得所有結果
+        return gpt_utils.generate_texts(base64_image, types, text_num=self.text_num, combined=self.single_request)
+
+    def text_for(self, base64_image, type, texts=None):
+        if texts is not None and type in texts:
+            return texts[type]
+        return self.generate_texts(base64_image, [type])[type]
+
+    def prepare_audio(self, base64_image, type, texts=None):
+        # 在 worker 中執行：文字（若尚未產生）-> TTS，回傳 (文字, 音檔 bytes)
+        text = self.text_for(base64_image, type, texts)
+        return text, TTS_utils.openai_tts_bytes(text, voice='random')
+
+    def dispatch_audio(self, audio, type, interrupt=True):
+        if self.audio_detach:
+            threading.Thread(target=self.socket_playaudio, args=(type, audio)).start()
+        else:
+            # 本機依 playlist 順序排入播放佇列，只有第一項會打斷開場音效，之後的項目接在前一項後面播放
+            sound.enqueue_mp3(audio, interrupt=interrupt)
+
+    def collect_in_order(self, types, futures):
+        # 依照 playlist 順序取得結果；個別項目失敗不影響其他項目
+        for type, future in zip(types, futures):
+            try:
+                yield type, future.result()
+            except Exception as e:
+                log_and_print(f"Failed to prepare {type}: {e}", 'error')
+
+    def image_to_audio(self, base64_image, type, texts=None):
+        if type not in gpt_utils.instruction_mapping:
             log_and_print("type must be 'describe', 'isart', or 'notart'", 'error')
             raise ValueError("type must be 'describe', 'isart', or 'notart'")
-        text_func, prefix = type_mapping[type]
-        text = text_func(base64_image)
-        audio_path = TTS_utils.openai_tts(text, prefix=prefix, voice='random')
-        if self.audio_detach:
-            threading.Thread(target=self.socket_playaudio, args=(type, audio_path)).start()
+        text, audio = self.prepare_audio(base64_image, type, texts)
+        self.dispatch_audio(audio, type)
+
+    def playlist_to_audio(self, base64_image, texts=None):
+        """
+        所有項目的 GPT/TTS 同時開始，依 playlist 順序播放：
+        前一項準備好且已送出後，下一項一準備好就排入播放佇列，本機播放時接在前一項播完後播放。
+        """
+        futures = [self.executor.submit(self.prepare_audio, base64_image, type, texts) for type in self.audio_playlist]
+        results = {}
+        for type, (text, audio) in self.collect_in_order(self.audio_playlist, futures):
+            self.dispatch_audio(audio, type, interrupt=not results)
+            results[type] = (text, [audio])
+        return results
+
+    def high_sync_image_to_audio(self, base64_image, texts=None):
+        # 同樣同時準備所有項目，但等全部準備好後才依序一起送出，讓各裝置的播放時間接近
+        futures = [self.executor.submit(self.prepare_audio, base64_image, type, texts) for type in self.audio_playlist]
+        ready = list(self.collect_in_order(self.audio_playlist, futures))
+        if self.audio_detach and self.device_pool is not None:
+            # 先把音檔傳到各裝置解碼，再依各裝置的時鐘差在同一個時刻開始播放
+            _, scheduled = self.device_pool.play_synchronized({type: audio for type, (text, audio) in ready})
+            for type, (text, audio) in ready:
+                if type not in scheduled:
+                    log_and_print(f"Device unavailable, playing {type} locally", 'warning')
+                    sound.enqueue_mp3(audio)
         else:
-            threading.Thread(target=sound.play_mp3, args=(audio_path,)).start()
-
-    def high_sync_image_to_audio(self, base64_image):
-        type_mapping = {
-            'describe': (lambda img: gpt_utils.describe_iamge(img, text_num=self.text_num), 'describe'),
-            'isart': (lambda img: gpt_utils.is_art(img, text_num=self.text_num), 'isart'),
-            'notart': (lambda img: gpt_utils.not_art(img, text_num=self.text_num), 'notart')
-        }
+            for i, (type, (text, audio)) in enumerate(ready):
+                self.dispatch_audio(audio, type, interrupt=i == 0)
+        return {type: (text, [audio]) for type, (text, audio) in ready}
+
+    def stream_audio_clips(self, base64_image, type, clip_queue, sentences):
+        """
+        在獨立的執行緒中執行（整段產生期間都佔用，不佔 executor 的 worker）：
+        以串流方式取得 GPT 文字，每完成一句就交給 executor 做 TTS，
+        依句子順序把 TTS 的 future 放進 clip_queue，結束時放入 None。
+        產生的句子同時記錄在 sentences 中。
+        """
+        # 與非串流時相同，由文字的 hash 決定聲音（以第一句決定），同一段內容的每一句使用同一個聲音，
+        # 重複的內容才會命中 TTS 快取
+        voice = None
+        try:
+            instruction = gpt_utils.instruction_mapping[type](self.text_num)
+            chunks = gpt_utils.call_api_stream(base64_image, instruction)
+            for i, sentence in enumerate(gpt_utils.split_sentences(chunks)):
+                sentences.append(sentence)
+                if voice is None:
+                    voice = TTS_utils.pick_voice(sentence)
+                clip_queue.put(self.executor.submit(TTS_utils.openai_tts_bytes, sentence, voice=voice))
+        except Exception as e:
+            log_and_print(f"Failed to stream {type}: {e}", 'error')
+        finally:
+            clip_queue.put(None)
+
+    def iter_clips(self, type, clip_queue, audio_clips):
+        """依句子順序 yield 完成 TTS 的音檔，同時記錄在 audio_clips 中。"""
+        while True:
+            future = clip_queue.get()
+            if future is None:
+                return
+            try:
+                audio = future.result()
+            except Exception as e:
+                log_and_print(f"Failed to synthesise {type}: {e}", 'error')
+                continue
+            audio_clips.append(audio)
+            yield audio
+
+    def socket_streamaudio(self, type, clips):
+        try:
+            self.device_request(type, lambda socket: socket.send_stream(clips))
+        except DeviceUnavailableError as e:
+            # 裝置離線時剩下的句子改在本機依序播放
+            log_and_print(f"Device unavailable, streaming {type} locally: {e}", 'warning')
+            for audio in clips:
+                sound.enqueue_mp3(audio)
+        except:
+            log_and_print("Socket connection failed for audio stream", 'error')
+            raise RuntimeError("Socket connection failed for audio stream")
+
+    def stream_playlist_to_audio(self, base64_image):
+        """
+        串流模式：所有項目同時開始產生，第一句完成 TTS 就開始播放，
+        其餘句子在播放的同時繼續產生。
+        本機播放時依 playlist 與句子順序無縫接續播放；
+        audio_detach 時每個項目各自以 stream 指令邊產生邊傳給對應的裝置。
+        """
+        clip_queues = []
         for type in self.audio_playlist:
-            text_func, prefix = type_mapping[type]
-            text = text_func(base64_image)
-            audio_path = TTS_utils.openai_tts(text, prefix=prefix, voice='random')
-            if self.audio_detach:
-                threading.Thread(target=self.socket_playaudio, args=(type, audio_path)).start()
+            clip_queue, sentences = queue.Queue(), []
+            # 串流的產生者各自使用一個執行緒，executor 的 worker 全部留給各句的 TTS
+            threading.Thread(target=self.stream_audio_clips, args=(base64_image, type, clip_queue, sentences),
+                             daemon=True).start()
+            clip_queues.append((type, clip_queue, sentences, []))
+        if self.audio_detach:
+            threads = [threading.Thread(target=self.socket_streamaudio,
+                                        args=(type, self.iter_clips(type, clip_queue, audio_clips)))
+                       for type, clip_queue, sentences, audio_clips in clip_queues]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            first_clip = True
+            for type, clip_queue, sentences, audio_clips in clip_queues:
+                for audio in self.iter_clips(type, clip_queue, audio_clips):
+                    # 第一句會打斷開場音效
+                    sound.enqueue_mp3(audio, interrupt=first_clip)
+                    first_clip = False
+        results = {}
+        for type, clip_queue, sentences, audio_clips in clip_queues:
+            if audio_clips and len(audio_clips) == len(sentences):
+                results[type] = (''.join(sentences), audio_clips)
+        return results
+
+    def play_cached(self, cached):
+        """快取命中：直接播放/列印之前產生的結果，不呼叫任何 API。"""
+        if self.audio_playlist:
+            first_clip = True
+            for type in self.audio_playlist:
+                audio_paths = cached['audio'][type]
+                if len(audio_paths) == 1:
+                    self.dispatch_audio(audio_paths[0], type, interrupt=first_clip)
+                    first_clip = False
+                    continue
+                # 串流模式留下的分句音檔，依序無縫播放
+                if self.audio_detach:
+                    clips = []
+                    for audio_path in audio_paths:
+                        with open(audio_path, 'rb') as f:
+                            clips.append(f.read())
+                    threading.Thread(target=self.socket_streamaudio, args=(type, iter(clips))).start()
+                    continue
+                for audio_path in audio_paths:
+                    sound.enqueue_mp3(audio_path, interrupt=first_clip)
+                    first_clip = False
+        for type in self.printer_list:
+            text = cached['texts'][type]
+            print(text)
+            if self.printer_detach:
+                threading.Thread(target=self.socket_printtext, args=('printer', text)).start()
             else:
-                threading.Thread(target=sound.play_mp3, args=(audio_path,)).start()
+                self.printer_manager.print_text(text)
 
-    def image_to_printer(self, base64_image, printer_name):
-        type_mapping = {
-            'describe': (lambda img: gpt_utils.describe_iamge(img, text_num=self.text_num), 'describe'),
-            'isart': (lambda img: gpt_utils.is_art(img, text_num=self.text_num), 'isart'),
-            'notart': (lambda img: gpt_utils.not_art(img, text_num=self.text_num), 'notart')
-        }
+    def audio_and_cache(self, audio_pipeline, args, image_hash, texts, printed_texts):
+        results = audio_pipeline(*args)
+        if self.content_cache is None or image_hash is None:
+            return
+        # 所有項目都成功時才寫入快取，避免之後命中不完整的結果
+        if any(type not in results for type in self.audio_playlist):
+            return
+        texts = dict(texts or {})
+        texts.update(printed_texts.result())
+        texts.update({type: text for type, (text, _) in results.items()})
+        if any(type not in texts for type in self.printer_list):
+            return
+        self.content_cache.store(image_hash, texts, {type: paths for type, (_, paths) in results.items()},
+                                 ext=TTS_utils.file_extension())
 
-        for type in self.printer_list:
-            text_func, prefix = type_mapping[type]
-            text = text_func(base64_image)
+    def image_to_printer(self, base64_image, printer_name, texts=None):
+        futures = [self.executor.submit(self.text_for, base64_image, type, texts) for type in self.printer_list]
+        printed = {}
+        for type, text in self.collect_in_order(self.printer_list, futures):
+            printed[type] = text
             print(text)
             if self.printer_detach:
                 threading.Thread(target=self.socket_printtext, args=(printer_name, text)).start()
             else:
                 self.printer_manager.print_text(text)
+        return printed
 
     def trigger_action(self, image):
         log_and_print("NOW TRIGGER ACTION with new image", 'info')
 
+        image = image.color()
+        if image is None:
+            log_and_print("Failed to decode trigger image.", 'error')
+            return
         height, width = image.shape[:2]
         size = min(width, height)
         start_x = (width - size) // 2
         start_y = (height - size) // 2
         image = image[start_y:start_y+size, start_x:start_x+size]
         image = self.center_crop(image, gray_resize_blur=False)
-        image = gpt_utils.npimageResize(image, 0.5)
-        base64_image = gpt_utils.image2base64(image)
-
-        self.image_to_printer(base64_image, 'printer')
-        # self.socket_printtext('printer', 'THIS IS A PRINTER TEST TEXT')
-
-        # if self.audio_detach:
-        #     threading.Thread(target=self.socket_playintro).start()
-        # else:
-        #     threading.Thread(target=sound.play_mp3, args=(self.intro_sound_path,)).start()
-        # if self.high_sync:
-        #     self.high_sync_image_to_audio(base64_image)
-        # else:
-        #     for audio_type in self.audio_playlist:
-        #         self.image_to_audio(base64_image, audio_type)
+
+        # 同一個物品再次放上展台時直接使用快取的文字與音檔
+        image_hash = None
+        if self.content_cache is not None:
+            image_hash = cache_utils.dhash(image)
+            cached = self.content_cache.lookup(image_hash)
+            if cached is not None and all(type in cached['audio'] for type in self.audio_playlist) \
+                    and all(type in cached['texts'] for type in self.printer_list):
+                self.play_cached(cached)
+                return
+
+        # 依位元組與 token 上限編碼，上傳大小不受相機解析度影響
+        base64_image = gpt_utils.encode_image(image, **self.image_budget)
+
+        # 先播放開場音效，GPT/TTS 在背景進行
+        if self.audio_playlist:
+            if self.audio_detach:
+                threading.Thread(target=self.socket_playintro).start()
+            else:
+                sound.play_mp3_threaded(self.intro_sound_path)
+
+        # single_request 時印表機與所有語音需要的文字一次產生，同一張圖片只上傳一次；
+        # 否則每個項目各自在 worker 中呼叫 GPT
+        # 串流播放時語音文字由串流另外產生
+        stream_audio = self.stream_audio
+        text_types = self.printer_list if stream_audio else self.printer_list + self.audio_playlist
+        texts = None
+        if self.single_request and text_types:
+            try:
+                texts = self.generate_texts(base64_image, text_types)
+            except http_utils.APIError as e:
+                log_and_print(f"Failed to generate texts: {e}", 'error')
+                return
+
+        # 印表機的文字完成後交給語音的執行緒，一起寫入快取
+        printed_texts = Future()
+        if self.audio_playlist:
+            if stream_audio:
+                audio_pipeline, pipeline_args = self.stream_playlist_to_audio, (base64_image,)
+            else:
+                audio_pipeline = self.high_sync_image_to_audio if self.high_sync else self.playlist_to_audio
+                pipeline_args = (base64_image, texts)
+            threading.Thread(target=self.audio_and_cache,
+                             args=(audio_pipeline, pipeline_args, image_hash, texts, printed_texts)).start()
+
+        printed = {}
+        try:
+            if self.printer_list:
+                printed = self.image_to_printer(base64_image, 'printer', texts)
+        finally:
+            printed_texts.set_result(printed)
+        if not self.audio_playlist and self.content_cache is not None and len(printed) == len(self.printer_list):
+            self.content_cache.store(image_hash, printed, {})
             
     def run(self):
+        # 等待 FrameGrabber 發佈新影像，每張影像只處理一次
+        seq = 0
         while True:
-            self.state_machine()
+            seq, frame_data = self.frame_grabber.wait_for_frame(seq, timeout=1.0)
+            if frame_data is None:
+                continue
+            self.state_machine(frame_data)
+            # 展台空著且穩定時降低處理頻率，coarse 層級一有變化就立刻全速
+            self.frame_grabber.set_min_interval(self.governor.interval_for(self.state, self.coarse_change))
 
 if __name__ == "__main__":
     log_dir = 'logs'
@@ -392,7 +774,29 @@ if __name__ == "__main__":
     parser.add_argument("--printer_detach", type=str, default='False')
     parser.add_argument("--printer_list", type=str, default='')
     parser.add_argument("--high_sync", type=str, default='False')
+    parser.add_argument("--single_request", type=str, default='True', help="Generate all playlist texts with one GPT call")
+    parser.add_argument("--content_cache", type=str, default='False', help="Reuse texts and audio for objects placed again")
+    parser.add_argument("--cache_distance", type=int, default=10, help="Max Hamming distance of the 256-bit dHash counted as the same object")
+    parser.add_argument("--cache_max_mb", type=int, default=200, help="Disk budget of the content cache in MB")
+    parser.add_argument("--image_max_edge", type=int, default=512, help="Longest edge in pixels of the image sent to GPT")
+    parser.add_argument("--image_max_kb", type=int, default=80, help="Max size in KB of the base64 image sent to GPT")
+    parser.add_argument("--image_token_budget", type=int, default=None, help="Max estimated image prompt tokens, switches to detail=low when exceeded")
+    parser.add_argument("--image_detail", type=str, default='auto', choices=['auto', 'low', 'high'], help="Image detail mode of the GPT request")
+    parser.add_argument("--image_quality", type=int, default=85, help="Initial JPEG quality of the image sent to GPT")
+    parser.add_argument("--audio_format", type=str, default='mp3', choices=list(TTS_utils.audio_formats), help="TTS output format: mp3, opus (smallest transfer) or pcm (no decoding)")
+    parser.add_argument("--tts_cache", type=str, default='True', help="Cache synthesised speech on disk by (model, voice, text)")
+    parser.add_argument("--tts_cache_max_mb", type=int, default=100, help="Disk budget of the TTS cache in MB")
+    parser.add_argument("--tts_preload_file", type=str, default=None, help="Text file with one phrase per line to synthesise into the TTS cache at startup")
+    parser.add_argument("--stream_audio", type=str, default='False', help="Stream GPT text into sentence-level TTS and play while generating")
+    parser.add_argument("--device_pool", type=str, default='True', help="Keep persistent connections to the detached devices")
+    parser.add_argument("--device_discovery", type=str, default='True', help="Discover detached devices over UDP broadcast and route only to healthy ones")
+    parser.add_argument("--device_timeout", type=float, default=1.0, help="Connect deadline in seconds for detached devices")
     parser.add_argument("--dslr", action="store_true", help="Use DSLR for live view and parameter adjustment")
+    parser.add_argument("--background_model", type=str, default='static', choices=list(BACKGROUND_MODELS), help="Background model used in IDLE state")
+    parser.add_argument("--background_alpha", type=float, default=0.02, help="Learning rate of the adaptive background model")
+    parser.add_argument("--background_update_interval", type=float, default=1.0, help="Seconds between background model updates in IDLE state")
+    parser.add_argument("--frame_budget", type=str, default='IDLE=4,CHANGE=0,DETECTED=2', help="Frames per second processed in each state, 0 means unlimited")
+    parser.add_argument("--gray_reduce", type=int, default=4, choices=[1, 2, 4, 8], help="Downscale factor of the grayscale decode used for motion detection")
     args = parser.parse_args()
 
     log_and_print('================================ Pedestal Start ================================', 'info')
@@ -415,16 +819,60 @@ if __name__ == "__main__":
 
     high_sync = False if args.high_sync != 'True' else True
     log_and_print(f'high_sync: {high_sync}', 'info')
+    single_request = False if args.single_request != 'True' else True
+    log_and_print(f'single_request: {single_request}', 'info')
+    stream_audio = False if args.stream_audio != 'True' else True
+    log_and_print(f'stream_audio: {stream_audio}', 'info')
+    if not gpt_utils.MIN_JPEG_QUALITY <= args.image_quality <= 100:
+        parser.error(f"--image_quality must be between {gpt_utils.MIN_JPEG_QUALITY} and 100")
+    image_budget = {'max_edge': args.image_max_edge, 'max_bytes': args.image_max_kb * 1024,
+                    'token_budget': args.image_token_budget, 'detail': args.image_detail, 'quality': args.image_quality}
+    log_and_print(f'image_budget: {image_budget}', 'info')
+    TTS_utils.set_audio_format(args.audio_format)
+    log_and_print(f'audio_format: {args.audio_format}', 'info')
+    if args.tts_cache == 'True':
+        TTS_utils.enable_cache(max_bytes=args.tts_cache_max_mb * 1024 * 1024)
+    log_and_print(f'tts_cache: {args.tts_cache} ({args.tts_cache_max_mb} MB)', 'info')
+    content_cache = None
+    if args.content_cache == 'True':
+        content_cache = cache_utils.PerceptualCache(max_distance=args.cache_distance, max_bytes=args.cache_max_mb * 1024 * 1024)
+    log_and_print(f'content_cache: {content_cache is not None} (distance {args.cache_distance}, {args.cache_max_mb} MB)', 'info')
+    device_names = (playlist if audio_detach else []) + (['printer'] if printer_detach and printer_list else [])
+    device_registry = None
+    if args.device_discovery == 'True' and device_names:
+        device_registry = DeviceRegistry(device_names)
+    log_and_print(f'device_discovery: {device_registry is not None}', 'info')
+    device_pool = None
+    if args.device_pool == 'True' and device_names:
+        device_pool = DeviceConnectionPool(device_names, connect_timeout=args.device_timeout,
+                                           io_timeout=args.device_timeout * 3, registry=device_registry)
+    log_and_print(f'device_pool: {device_pool is not None} ({device_names}, timeout {args.device_timeout}s)', 'info')
+    log_and_print(f'gray_reduce: {args.gray_reduce}', 'info')
+    frame_budget = RateGovernor.parse_budget(args.frame_budget)
+    log_and_print(f'frame_budget: {frame_budget}', 'info')
+    log_and_print(f'background_model: {args.background_model} (alpha {args.background_alpha}, every {args.background_update_interval}s)', 'info')
     log_and_print('================================================================================', 'info')
     log_and_print("Now activating pedestal", 'info')
     
+    # 先建立 API 連線，第一次觸發時不用等 TLS handshake
+    http_utils.warm_up()
+    if args.tts_preload_file:
+        with open(args.tts_preload_file, 'r', encoding='utf-8') as f:
+            TTS_utils.prepopulate([line.strip() for line in f if line.strip()])
+
     if args.dslr:
         cap = DSLRCapture()
     else:
         cap = cv2.VideoCapture(0)
     
     detector = MotionDetector(cap, zoom=args.zoom, text_num=args.text_num, detect_interval=args.detect_interval,
-                                audio_detach=audio_detach, audio_playlist=playlist, printer_detach=printer_detach, printer_list=printer_list, high_sync=high_sync)
+                                audio_detach=audio_detach, audio_playlist=playlist, printer_detach=printer_detach, printer_list=printer_list, high_sync=high_sync,
+                                gray_reduce=args.gray_reduce, background_model=args.background_model,
+                                background_alpha=args.background_alpha, background_update_interval=args.background_update_interval,
+                                frame_budget=frame_budget, single_request=single_request,
+                                stream_audio=stream_audio, content_cache=content_cache,
+                                image_budget=image_budget, device_pool=device_pool,
+                                device_registry=device_registry, device_timeout=args.device_timeout)
     detector.run()
     
     # python run.py --zoom 5 --audio_playlist ID --dslr
@@ -1,69 +1,293 @@
 import time
 import os
+import io
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
 import pygame
 import threading
+import queue
+import collections
 import argparse
 from utils import log_and_print
 import logging
 
-# 紀錄當前播放的執行緒與控制變數
-current_thread = None
-stop_flag = False  # 用來通知執行緒應該停止
-lock = threading.Lock()  # 確保執行緒同步
+MIXER_FREQUENCY = 48000
+# 較小的 buffer 讓開始播放的延遲只有數 ms（1024 / 48000 ≈ 21 ms）
+MIXER_BUFFER = 1024
+VOLUME = 0.8
+ENGINE_CHANNEL = 0
+mixer_lock = threading.Lock()
 
 
-def play_mp3(file_path):
+def init_mixer():
+    # 初始化 pygame.mixer（如果尚未初始化），整個程式只初始化一次
+    with mixer_lock:
+        if not pygame.mixer.get_init():
+            pygame.mixer.init(frequency=MIXER_FREQUENCY, size=-16, channels=2, buffer=MIXER_BUFFER)
+
+
+def audio_source(audio):
     """
-    Play an MP3 file, but allows interruption by checking `stop_flag`.
+    音檔路徑直接使用；bytes 則包成 BytesIO，從記憶體播放不落地。
+    格式（mp3、Ogg Opus、WAV）由 SDL_mixer 依內容判斷，呼叫端不需要指定。
     """
-    global stop_flag
+    if isinstance(audio, (bytes, bytearray)):
+        return io.BytesIO(audio)
+    return audio
 
-    with lock:
-        # 強制停止任何正在播放的音訊
-        if pygame.mixer.get_init():
-            pygame.mixer.music.stop()
-            pygame.mixer.stop()
-            time.sleep(0.1)
 
-        # 初始化 pygame.mixer（如果尚未初始化）
-        if not pygame.mixer.get_init():
-            pygame.mixer.init(frequency=48000, size=-16, channels=2, buffer=8192)
+class Playback:
+    """
+    一個排入 AudioEngine 的音檔。
+    start_time 為實際開始播放的時間（time.time()），started / finished 可用來等待。
+    """
 
-    try:
-        # 載入與播放音樂
-        pygame.mixer.music.load(file_path)
-        pygame.mixer.music.set_volume(0.8)
-        pygame.mixer.music.play()
-
-        # 等待音樂播放完成，但允許中途被強制停止
-        while pygame.mixer.music.get_busy():
-            if stop_flag:
-                pygame.mixer.music.stop()
-                return  # 停止當前執行緒
-            time.sleep(0.1)
+    def __init__(self, clip, name):
+        self.clip = clip
+        self.name = name
+        self.duration = clip.get_length()
+        self.start_time = None
+        self.interrupted = False
+        self.started = threading.Event()
+        self.finished = threading.Event()
 
-    except Exception as e:
-        log_and_print(f"Error playing audio: {str(e)}", "ERROR")
+    def mark_started(self):
+        self.start_time = time.time()
+        self.started.set()
 
-    finally:
-        pygame.mixer.music.stop()
+    def mark_finished(self, interrupted=False):
+        self.interrupted = interrupted
+        self.started.set()
+        self.finished.set()
 
+    def wait_started(self, timeout=None):
+        """等待開始播放，回傳開始時間（被中斷而沒有播放時為 None）。"""
+        self.started.wait(timeout)
+        return self.start_time
 
-def play_mp3_threaded(file_path):
+    def wait(self, timeout=None):
+        """等待播放結束（或被中斷）。"""
+        return self.finished.wait(timeout)
+
+
+class AudioEngine:
     """
-    確保前一個執行緒結束後，才開啟新的播放執行緒。
+    常駐的播放執行緒：mixer 只初始化一次，所有播放都在同一個 Channel 上，
+    透過指令佇列接收 play / enqueue / interrupt / preload，避免多個執行緒互相搶 mixer。
+    preload 的音檔會解碼後常駐記憶體，之後播放不需要再讀檔與解碼。
     """
-    global current_thread, stop_flag
 
-    # 設定 stop_flag，讓舊的執行緒可以結束
-    stop_flag = True
-    time.sleep(0.2)  # 給舊執行緒時間檢查 stop_flag 並結束
+    def __init__(self):
+        init_mixer()
+        self.channel = pygame.mixer.Channel(ENGINE_CHANNEL)
+        self.commands = queue.Queue()
+        self.clips = {}  # 常駐記憶體的已解碼音檔 {key: pygame.mixer.Sound}
+        self.clips_lock = threading.Lock()
+        self.pending = collections.deque()  # 等待播放的 Playback
+        self.current = None  # 正在播放的 Playback
+        self.current_end = None  # current 預計結束的時間（time.monotonic()）
+        self.queued = None  # 已用 Channel.queue 排在 current 之後的 Playback
+        self.scheduled = []  # 指定時間開始的 (start_time, Playback)，依時間排序
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def load(self, audio):
+        """
+        取得已解碼的音檔：已解碼的 Sound 與常駐的 key（含 preload 過的路徑）直接使用，
+        否則在呼叫端的執行緒解碼，播放執行緒不會被解碼卡住。
+        """
+        if isinstance(audio, pygame.mixer.Sound):
+            return audio
+        if isinstance(audio, str):
+            with self.clips_lock:
+                clip = self.clips.get(audio)
+            if clip is not None:
+                return clip
+        clip = pygame.mixer.Sound(audio_source(audio))
+        clip.set_volume(VOLUME)
+        return clip
+
+    @staticmethod
+    def name_of(audio):
+        if isinstance(audio, str):
+            return audio
+        if isinstance(audio, pygame.mixer.Sound):
+            return f"<{audio.get_length():.2f}s clip>"
+        return f"<{len(audio)} bytes>"
+
+    def play(self, audio):
+        """打斷目前的播放並立即播放，回傳 Playback。"""
+        playback = Playback(self.load(audio), self.name_of(audio))
+        self.commands.put(('play', playback))
+        return playback
+
+    def enqueue(self, audio, interrupt=False):
+        """
+        加入依序播放的佇列，前一個音檔播完後無縫接著播放，回傳 Playback。
+        interrupt 為 True 時先停止目前所有播放並清空佇列（新的一段內容開始）。
+        """
+        playback = Playback(self.load(audio), self.name_of(audio))
+        self.commands.put(('play' if interrupt else 'enqueue', playback))
+        return playback
+
+    def play_at(self, audio, start_time):
+        """
+        在 start_time（time.time() 的時間）打斷目前的播放並開始播放，回傳 Playback。
+        播放執行緒會在該時刻醒來，多台裝置時鐘同步時可以在同一個瞬間開始。
+        """
+        playback = Playback(self.load(audio), self.name_of(audio))
+        self.commands.put(('play_at', (start_time, playback)))
+        return playback
+
+    def interrupt(self):
+        self.commands.put(('interrupt', None))
+
+    def preload(self, audio, key=None):
+        """解碼後常駐記憶體；key 預設為檔案路徑，之後 play(key) 直接使用。"""
+        key = key if key is not None else audio
+        self.commands.put(('preload', (key, audio)))
+
+    def _run(self):
+        while True:
+            deadlines = []
+            if self.current is not None:
+                deadlines.append(self.current_end - time.monotonic())
+            if self.scheduled:
+                deadlines.append(self.scheduled[0][0] - time.time())
+            timeout = max(0.0, min(deadlines)) if deadlines else None
+            # 沒有在播放時一直等待指令；播放中或有預定播放時，最多等到下一個時間點
+            try:
+                command, arg = self.commands.get(timeout=timeout)
+            except queue.Empty:
+                command = None
+            try:
+                if command is not None:
+                    self._handle(command, arg)
+                self._advance()
+            except Exception as e:
+                log_and_print(f"Audio engine error: {str(e)}", 'error')
+
+    def _handle(self, command, arg):
+        if command == 'play':
+            self._stop_all()
+            self.pending.append(arg)
+        elif command == 'enqueue':
+            self.pending.append(arg)
+        elif command == 'play_at':
+            self.scheduled.append(arg)
+            self.scheduled.sort(key=lambda item: item[0])
+        elif command == 'interrupt':
+            self._stop_all()
+            for _, playback in self.scheduled:
+                playback.mark_finished(interrupted=True)
+            self.scheduled = []
+        elif command == 'preload':
+            key, audio = arg
+            try:
+                clip = pygame.mixer.Sound(audio_source(audio))
+                clip.set_volume(VOLUME)
+            except Exception as e:
+                log_and_print(f"Error preloading audio {key}: {str(e)}", 'error')
+                return
+            with self.clips_lock:
+                self.clips[key] = clip
+            log_and_print(f"Audio preloaded: {key} ({clip.get_length():.2f}s)", 'info')
+
+    def _stop_all(self):
+        self.channel.stop()
+        for playback in [self.current, self.queued, *self.pending]:
+            if playback is not None:
+                playback.mark_finished(interrupted=True)
+        self.current, self.queued, self.current_end = None, None, None
+        self.pending.clear()
+
+    def _start(self, playback):
+        playback.mark_started()
+        self.current = playback
+        self.current_end = time.monotonic() + playback.duration
+        log_and_print(f"Audio started: {playback.name} at {playback.start_time:.3f}", 'debug')
+
+    def _advance(self):
+        while self.scheduled and time.time() >= self.scheduled[0][0]:
+            start_time, playback = self.scheduled.pop(0)
+            self._stop_all()
+            self.channel.play(playback.clip)
+            self._start(playback)
+            log_and_print(f"Scheduled audio started {(playback.start_time - start_time) * 1000:.1f} ms after target", 'debug')
+        if self.current is not None and time.monotonic() >= self.current_end:
+            if self.queued is not None and self.channel.get_queue() is not None:
+                # 預估的結束時間比實際稍早，queued 還沒接上，稍後再檢查
+                self.current_end = time.monotonic() + 0.005
+                return
+            self.current.mark_finished()
+            self.current = None
+            if self.queued is not None:
+                # Channel.queue 已在前一個結束時無縫接上
+                queued, self.queued = self.queued, None
+                self._start(queued)
+        if self.current is None and self.pending:
+            playback = self.pending.popleft()
+            self.channel.play(playback.clip)
+            self._start(playback)
+        # Channel 只有一個等待位置：預先排入下一個，播完時由 mixer 直接接上
+        if self.current is not None and self.queued is None and self.pending:
+            self.queued = self.pending.popleft()
+            self.channel.queue(self.queued.clip)
+
 
-    # 開啟新的播放執行緒
-    stop_flag = False  # 重設 stop_flag，允許新音樂播放
-    current_thread = threading.Thread(target=play_mp3, args=(file_path,))
-    current_thread.start()
+engine = None
+engine_lock = threading.Lock()
+
+
+def get_engine():
+    """取得（必要時建立）全程式共用的 AudioEngine。"""
+    global engine
+    with engine_lock:
+        if engine is None:
+            engine = AudioEngine()
+        return engine
+
+
+def preload(file_path, key=None):
+    get_engine().preload(file_path, key)
+
+
+def interrupt():
+    get_engine().interrupt()
+
+
+def play_mp3(file_path):
+    """
+    Play an MP3 file (path, preloaded key or bytes), interrupting any current playback,
+    and block until it finishes or is interrupted.
+    """
+    try:
+        playback = get_engine().play(file_path)
+    except Exception as e:
+        log_and_print(f"Error playing audio: {str(e)}", "error")
+        return None
+    playback.wait()
+    return playback
+
+
+def play_mp3_threaded(file_path):
+    """打斷目前的播放並立即播放，不等待播放結束；回傳 Playback。"""
+    try:
+        return get_engine().play(file_path)
+    except Exception as e:
+        log_and_print(f"Error playing audio: {str(e)}", "error")
+        return None
+
+
+def enqueue_mp3(file_path, interrupt=False):
+    """
+    把音檔（路徑或 bytes）加入依序播放佇列，前一個音檔播完後無縫接著播放。
+    interrupt 為 True 時先停止目前所有播放並清空佇列（新的一段內容開始）。
+    """
+    try:
+        return get_engine().enqueue(file_path, interrupt=interrupt)
+    except Exception as e:
+        log_and_print(f"Error loading audio: {str(e)}", "error")
+        return None
 
 
 if __name__ == "__main__":
@@ -85,9 +309,14 @@ if __name__ == "__main__":
     mp3_path = args.path
 
     if args.pressuretest:
+        preload(mp3_path)
         for _ in range(args.repeattime):
             print(f"{_}/{args.repeattime}")
-            play_mp3_threaded(mp3_path)
+            requested = time.time()
+            playback = play_mp3_threaded(mp3_path)
+            start_time = playback.wait_started() if playback is not None else None
+            if start_time is not None:
+                print(f"start latency: {(start_time - requested) * 1000:.1f} ms")
             time.sleep(0.2)  # 減少間隔，測試播放中斷
     else:
         if os.path.exists(mp3_path):
@@ -0,0 +1,402 @@
+import os
+import cv2
+import numpy as np
+from utils import log_and_print
+
+SOI = b'\xff\xd8'
+EOI = b'\xff\xd9'
+
+
+class MJPEGStreamParser:
+    """
+    從 MJPEG 位元組串流中切出 JPEG 影像。
+    使用預先配置的 bytearray 作為固定大小緩衝區，並記錄上次掃描位置，
+    每次只掃描新進來的資料；一次讀取中若湊齊多張影像，只保留最新的一張。
+    """
+
+    def __init__(self, capacity=4 * 1024 * 1024, chunk_size=64 * 1024):
+        self.capacity = capacity
+        self.chunk_size = chunk_size
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0          # 尚未處理資料的起點
+        self.end = 0            # 已寫入資料的終點
+        self.scan_pos = 0       # 下一次掃描的起點
+        self.soi_idx = -1       # 目前影像的起始位置（-1 表示尚未找到 SOI）
+        self.latest = None      # 最新一張完整影像的 (start, end)
+        self.dropped_frames = 0
+
+    def _compact(self):
+        # 把尚未處理的資料搬回緩衝區開頭，只搬移有效區段
+        if self.start == 0:
+            return
+        keep_from = self.start
+        if self.latest is not None:
+            keep_from = min(keep_from, self.latest[0])
+        length = self.end - keep_from
+        self.buffer[0:length] = self.view[keep_from:self.end]
+        self.start -= keep_from
+        self.end = length
+        self.scan_pos -= keep_from
+        if self.soi_idx != -1:
+            self.soi_idx -= keep_from
+        if self.latest is not None:
+            self.latest = (self.latest[0] - keep_from, self.latest[1] - keep_from)
+
+    def _reserve(self, n):
+        """確保尾端至少有 n bytes 可寫入，回傳可用的 memoryview。"""
+        if self.capacity - self.end < n:
+            self._compact()
+        if self.capacity - self.end < n:
+            # 緩衝區已滿仍找不到 EOI：丟棄這張不完整的影像，避免無限制成長
+            log_and_print("MJPEG buffer overflow, dropping incomplete frame.", 'warning')
+            self.latest = None
+            self.start = self.end = self.scan_pos = 0
+            self.soi_idx = -1
+        return self.view[self.end:self.end + min(n, self.capacity - self.end)]
+
+    def feed(self, data):
+        """寫入一段資料（給非 pipe 來源使用）。"""
+        data = memoryview(data)
+        while len(data) > 0:
+            target = self._reserve(min(len(data), self.chunk_size))
+            n = len(target)
+            target[:] = data[:n]
+            self.end += n
+            data = data[n:]
+            self._scan()
+
+    def feed_from(self, stream):
+        """
+        直接從串流讀入緩衝區（零複製）。
+        回傳讀到的位元組數，0 表示 EOF。
+        """
+        target = self._reserve(self.chunk_size)
+        if hasattr(stream, 'readinto1'):
+            n = stream.readinto1(target)
+        else:
+            n = os.readv(stream.fileno(), [target])
+        if n:
+            self.end += n
+            self._scan()
+        return n or 0
+
+    def _scan(self):
+        while True:
+            if self.soi_idx == -1:
+                idx = self.buffer.find(SOI, self.scan_pos, self.end)
+                if idx == -1:
+                    # 保留最後一個位元組，避免標記剛好被切在兩段之間
+                    self.scan_pos = max(self.start, self.end - 1)
+                    if self.latest is None:
+                        self.start = self.scan_pos
+                    return
+                self.soi_idx = idx
+                self.scan_pos = idx + 2
+            idx = self.buffer.find(EOI, self.scan_pos, self.end)
+            if idx == -1:
+                self.scan_pos = max(self.soi_idx + 2, self.end - 1)
+                return
+            if self.latest is not None:
+                self.dropped_frames += 1
+            self.latest = (self.soi_idx, idx + 2)
+            self.start = self.scan_pos = idx + 2
+            self.soi_idx = -1
+
+    def pop_latest(self):
+        """取出最新一張完整的 JPEG（bytes），較舊的影像直接略過。"""
+        if self.latest is None:
+            return None
+        s, e = self.latest
+        jpg = bytes(self.view[s:e])
+        self.latest = None
+        if self.soi_idx == -1 and self.start == self.end:
+            # 沒有殘留資料時直接歸零，省去搬移
+            self.start = self.end = self.scan_pos = 0
+        return jpg
+
+
+REDUCED_GRAYSCALE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+class EncodedFrame:
+    """
+    延遲解碼的影像：保留原始 JPEG，等到真的有人需要時才解碼。
+    motion 偵測只需要縮小的灰階影像，觸發時才需要全解析度彩色影像。
+    若來源本身已經是解碼後的影像（cv2.VideoCapture），則直接沿用。
+    """
+
+    def __init__(self, jpg=None, image=None, gray_reduce=4):
+        if jpg is None and image is None:
+            raise ValueError("EncodedFrame needs either jpg or image")
+        if gray_reduce not in REDUCED_GRAYSCALE_FLAGS:
+            raise ValueError(f"gray_reduce must be one of {list(REDUCED_GRAYSCALE_FLAGS)}")
+        self.jpg = jpg
+        self.gray_reduce = gray_reduce
+        self.seq = None  # 由 FrameGrabber 發佈時填入
+        self._color = image
+        self._gray = None
+
+    def color(self):
+        """全解析度 BGR 影像。"""
+        if self._color is None:
+            self._color = cv2.imdecode(np.frombuffer(self.jpg, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return self._color
+
+    def gray(self):
+        """縮小後的灰階影像，只用於 JPEG 來源：以 IMREAD_REDUCED_GRAYSCALE_* 在解碼時縮小。"""
+        if self.jpg is None:
+            raise ValueError("gray() needs a JPEG frame, use motion_image() for decoded frames")
+        if self._gray is None:
+            self._gray = cv2.imdecode(np.frombuffer(self.jpg, dtype=np.uint8),
+                                      REDUCED_GRAYSCALE_FLAGS[self.gray_reduce])
+        return self._gray
+
+    def motion_image(self):
+        """
+        交給 PreprocessEngine.load 的影像：JPEG 來源為解碼時縮小的灰階影像；
+        已解碼的來源直接回傳彩色影像，由引擎以 view 裁切後轉成灰階寫入自己的緩衝區，不另外配置。
+        """
+        return self.gray() if self.jpg is not None else self._color
+
+
+class Baseline:
+    """比對用的基準影像，同時保存 coarse 與 fine 兩個解析度。"""
+
+    def __init__(self, fine=None, coarse=None):
+        self.fine = fine
+        self.coarse = coarse
+
+
+class PreprocessEngine:
+    """
+    motion 偵測用的前處理流程：center crop -> 灰階 -> resize -> blur -> diff -> threshold。
+    所有輸出緩衝區依第一張影像的尺寸預先配置，裁切使用 view，
+    OpenCV 呼叫都透過 dst= 寫入既有緩衝區，穩定運作時不再配置新的陣列。
+
+    另外提供一個低解析度（coarse）層級作為 cascade 的第一關：
+    load() 之後 coarse() 與 fine() 都是需要時才計算，且每張影像只計算一次。
+    coarse 的 blur 與 diff_level 都比 fine 寬鬆，fine 看得到的變化 coarse 也會看到，才能放心略過 fine。
+    注意回傳的是引擎內部的緩衝區，下一張影像會覆寫它，需要保留請用 snapshot()。
+    """
+
+    def __init__(self, zoom=0, resized_shape=(224, 224), blur_ksize=(15, 15), diff_level=50,
+                 coarse_shape=(56, 56), coarse_blur_ksize=(3, 3), coarse_diff_level=25):
+        if zoom < 0:
+            log_and_print("zoom must be non-negative", 'error')
+            raise ValueError("zoom must be non-negative")
+        self.zoom = zoom
+        self.resized_shape = resized_shape
+        self.blur_ksize = blur_ksize
+        self.diff_level = diff_level
+        self.coarse_shape = coarse_shape
+        self.coarse_blur_ksize = coarse_blur_ksize
+        self.coarse_diff_level = coarse_diff_level
+        self.source_shape = None
+        # resized_shape 為 (width, height)，numpy 緩衝區為 (height, width)
+        buffer_shape = (resized_shape[1], resized_shape[0])
+        self.resized = np.empty(buffer_shape, dtype=np.uint8)
+        self.blurred = np.empty(buffer_shape, dtype=np.uint8)
+        self.diff = np.empty(buffer_shape, dtype=np.uint8)
+        coarse_buffer_shape = (coarse_shape[1], coarse_shape[0])
+        self.coarse_resized = np.empty(coarse_buffer_shape, dtype=np.uint8)
+        self.coarse_blurred = np.empty(coarse_buffer_shape, dtype=np.uint8)
+        self.coarse_diff = np.empty(coarse_buffer_shape, dtype=np.uint8)
+        self.gray = None
+        self.source = None
+        self.fine_ready = False
+        self.coarse_ready = False
+
+    def crop_box(self, height, width):
+        """與 MotionDetector.center_crop 相同的裁切範圍，回傳 (top, left, size)。"""
+        new_width = min(width, height)
+        top, left = (height - new_width) // 2, (width - new_width) // 2
+        if self.zoom > 0:
+            zoom_ratio = 1 + (self.zoom / 10)
+            zoomed_size = int(new_width / zoom_ratio)
+            crop_size = (new_width - zoomed_size) // 2
+            return top + crop_size, left + crop_size, zoomed_size
+        return top, left, new_width
+
+    def _configure(self, img):
+        # 只有第一張影像或來源尺寸改變時才重新計算裁切範圍與配置灰階緩衝區
+        self.source_shape = img.shape
+        self.box = self.crop_box(img.shape[0], img.shape[1])
+        size = self.box[2]
+        if img.ndim == 3 and img.shape[2] == 3:
+            self.gray = np.empty((size, size), dtype=np.uint8)
+        else:
+            self.gray = None
+
+    def crop(self, img):
+        if img.shape != self.source_shape:
+            self._configure(img)
+        top, left, size = self.box
+        return img[top:top+size, left:left+size]
+
+    def load(self, img):
+        """設定目前要處理的影像，coarse/fine 結果在第一次需要時才計算。"""
+        img = self.crop(img)
+        if self.gray is not None:
+            cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=self.gray)
+            img = self.gray
+        self.source = img
+        self.fine_ready = False
+        self.coarse_ready = False
+
+    def fine(self):
+        if not self.fine_ready:
+            cv2.resize(self.source, self.resized_shape, dst=self.resized)
+            cv2.GaussianBlur(self.resized, self.blur_ksize, 0, dst=self.blurred)
+            self.fine_ready = True
+        return self.blurred
+
+    def coarse(self):
+        if not self.coarse_ready:
+            cv2.resize(self.source, self.coarse_shape, dst=self.coarse_resized, interpolation=cv2.INTER_AREA)
+            cv2.GaussianBlur(self.coarse_resized, self.coarse_blur_ksize, 0, dst=self.coarse_blurred)
+            self.coarse_ready = True
+        return self.coarse_blurred
+
+    def process(self, img):
+        """回傳前處理後的影像（引擎內部緩衝區）。"""
+        self.load(img)
+        return self.fine()
+
+    def snapshot(self, into=None):
+        """把目前影像的 coarse/fine 結果複製到 baseline（into 為 None 時才配置新的）。"""
+        if into is None:
+            return Baseline(self.fine().copy(), self.coarse().copy())
+        np.copyto(into.fine, self.fine())
+        np.copyto(into.coarse, self.coarse())
+        return into
+
+    def changed_pixels(self, baseline, processed):
+        """absdiff + threshold 後超過 diff_level 的像素數。"""
+        cv2.absdiff(baseline, processed, dst=self.diff)
+        cv2.threshold(self.diff, self.diff_level, 255, cv2.THRESH_BINARY, dst=self.diff)
+        return cv2.countNonZero(self.diff)
+
+    def coarse_changed_pixels(self, baseline):
+        cv2.absdiff(baseline, self.coarse(), dst=self.coarse_diff)
+        cv2.threshold(self.coarse_diff, self.coarse_diff_level, 255, cv2.THRESH_BINARY, dst=self.coarse_diff)
+        return cv2.countNonZero(self.coarse_diff)
+
+    def cascade_changed_pixels(self, baseline):
+        """
+        coarse 層級作為保守的第一關：沒有變化就直接回傳 0，不計算 fine；
+        有變化時一律在 fine 層級確認，回傳 fine 的變化像素數。
+        回傳 (changed_pixels, coarse_changed)。
+        """
+        if self.coarse_changed_pixels(baseline.coarse) == 0:
+            return 0, False
+        return self.changed_pixels(baseline.fine, self.fine()), True
+
+
+class StaticBackground:
+    """啟動時擷取一次背景，之後不再更新（原本的行為）。"""
+
+    def __init__(self, engine, alpha=0.02, max_drift=8):
+        self.engine = engine
+        self.alpha = alpha
+        # update() 只在畫面與背景一致時呼叫，新的背景與目前影像的平均差異超過 max_drift 個灰階就視為模型出錯
+        self.max_drift = max_drift
+        self.baseline = None
+        self.candidate = None
+
+    def initialize(self):
+        """以引擎目前載入的影像作為初始背景。"""
+        self.baseline = self.engine.snapshot()
+        # 更新時先寫入 candidate，檢查通過才複製到 baseline
+        self.candidate = Baseline(np.empty_like(self.baseline.fine), np.empty_like(self.baseline.coarse))
+        return self.baseline
+
+    def update(self):
+        """以引擎目前載入的影像更新背景，只應在 IDLE 狀態呼叫。"""
+        pass
+
+    def drift(self, background, processed):
+        """background 與目前影像每個像素的平均灰階差異。"""
+        return cv2.norm(background, processed, cv2.NORM_L1) / background.size
+
+    def commit(self):
+        """candidate 與目前影像相差不超過 max_drift 時才寫回 baseline，持有 baseline 的地方不需要重新取得。"""
+        drift = max(self.drift(self.candidate.fine, self.engine.fine()),
+                    self.drift(self.candidate.coarse, self.engine.coarse()))
+        if drift > self.max_drift:
+            log_and_print(f"{type(self).__name__} background drifted {drift:.1f} grey levels from a matching frame, "
+                          f"keeping the previous background", 'warning')
+            return False
+        np.copyto(self.baseline.fine, self.candidate.fine)
+        np.copyto(self.baseline.coarse, self.candidate.coarse)
+        return True
+
+
+class RunningAverageBackground(StaticBackground):
+    """以 cv2.accumulateWeighted 維護背景的移動平均，慢慢跟上光線變化。"""
+
+    def initialize(self):
+        super().initialize()
+        self.acc_fine = self.baseline.fine.astype(np.float32)
+        self.acc_coarse = self.baseline.coarse.astype(np.float32)
+        return self.baseline
+
+    def update(self):
+        cv2.accumulateWeighted(self.engine.fine(), self.acc_fine, self.alpha)
+        cv2.accumulateWeighted(self.engine.coarse(), self.acc_coarse, self.alpha)
+        cv2.convertScaleAbs(self.acc_fine, dst=self.candidate.fine)
+        cv2.convertScaleAbs(self.acc_coarse, dst=self.candidate.coarse)
+        self.commit()
+
+
+class SubtractorBackground(StaticBackground):
+    """以 OpenCV 的 MOG2 / KNN background subtractor 維護背景影像。"""
+
+    factories = {
+        'mog2': lambda: cv2.createBackgroundSubtractorMOG2(detectShadows=False),
+        'knn': lambda: cv2.createBackgroundSubtractorKNN(detectShadows=False),
+    }
+
+    def __init__(self, engine, alpha=0.02, kind='mog2', seed_frames=10):
+        super().__init__(engine, alpha)
+        self.seed_frames = seed_frames
+        self.fine_subtractor = self.factories[kind]()
+        self.coarse_subtractor = self.factories[kind]()
+        self.fine_mask = np.empty_like(engine.blurred)
+        self.coarse_mask = np.empty_like(engine.coarse_blurred)
+
+    def initialize(self):
+        super().initialize()
+        # 以第一張影像重複建立模型（learningRate=-1 自動決定）：KNN 需要累積數個樣本後
+        # getBackgroundImage 才會是正確的背景，只套用一次（或 learningRate=1）會得到錯誤的背景
+        for _ in range(self.seed_frames):
+            self.fine_subtractor.apply(self.baseline.fine, self.fine_mask, -1)
+            self.coarse_subtractor.apply(self.baseline.coarse, self.coarse_mask, -1)
+        return self.baseline
+
+    def update(self):
+        self.fine_subtractor.apply(self.engine.fine(), self.fine_mask, self.alpha)
+        self.coarse_subtractor.apply(self.engine.coarse(), self.coarse_mask, self.alpha)
+        self.fine_subtractor.getBackgroundImage(self.candidate.fine)
+        self.coarse_subtractor.getBackgroundImage(self.candidate.coarse)
+        self.commit()
+
+
+BACKGROUND_MODELS = {
+    'static': StaticBackground,
+    'running_average': RunningAverageBackground,
+    'mog2': lambda engine, alpha: SubtractorBackground(engine, alpha, kind='mog2'),
+    'knn': lambda engine, alpha: SubtractorBackground(engine, alpha, kind='knn'),
+}
+
+
+def create_background_model(name, engine, alpha=0.02):
+    if name not in BACKGROUND_MODELS:
+        log_and_print(f"background model must be one of {list(BACKGROUND_MODELS)}", 'error')
+        raise ValueError(f"background model must be one of {list(BACKGROUND_MODELS)}")
+    return BACKGROUND_MODELS[name](engine, alpha)
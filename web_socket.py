@@ -1,10 +1,18 @@
 import socket
 import threading
+import asyncio
+import itertools
+import hashlib
+import collections
 import os
 import argparse
 import time
 import struct
+import json
+import random
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from device_ip import addr_dict, inv_addr_dict
+from device_registry import DISCOVERY_PORT, DiscoveryResponder
 import sound
 from utils import log_and_print
 import logging
@@ -13,160 +21,690 @@ import platform
 if platform.machine() in ('armv7l', 'armv6l', 'aarch64'):
     import printer
 
-def recv_msg(sock):
-    # Read message length and unpack it into an integer
-    raw_msglen = recvall(sock, 4)
-    if not raw_msglen:
-        return None
-    msglen = struct.unpack('>I', raw_msglen)[0]
-    return recvall(sock, msglen)
+# 每個 frame：1 byte 種類 + 4 byte request id + 4 byte 長度 + 資料
+# 同一條連線可以同時有多個未完成的請求，回應以 request id 對應
+FRAME_HEADER = struct.Struct('>BII')
+FRAME_PING = 1  # -> PONG
+FRAME_PONG = 2
+FRAME_ACK = 3  # 請求完成，資料為回應文字
+FRAME_ERR = 4  # 請求失敗，資料為錯誤訊息
+FRAME_PLAY = 5  # 資料為音檔，打斷目前的播放並立即播放
+FRAME_ENQUEUE = 6  # 資料為音檔，排在目前的播放之後
+FRAME_STREAM_DATA = 7  # 串流中目前音檔的一段資料
+FRAME_STREAM_CLIP = 8  # 串流中目前音檔結束，可以解碼播放
+FRAME_STREAM_END = 9  # 串流結束 -> ACK
+FRAME_PRINT = 10  # 資料為 UTF-8 文字 -> ACK，資料為列印工作的 job id
+FRAME_ASSET = 11  # 資料為 (要執行的 frame 種類, 音檔的 SHA-256)，Pi 有這個音檔時直接使用，否則回覆 MISS
+FRAME_TIME_SYNC = 12  # -> ACK，資料為 Pi 收到與送出回應的時間 (t1, t2)
+FRAME_PRELOAD = 13  # 資料為音檔，先解碼保存，ACK 後等待 PLAY_AT
+FRAME_PLAY_AT = 14  # 資料為 (PRELOAD 的 request id, Pi 時鐘的開始時間)
+TIME_SYNC_PAYLOAD = struct.Struct('>dd')
+PLAY_AT_PAYLOAD = struct.Struct('>Id')
+FRAME_MISS = 15  # FRAME_ASSET 的音檔不在 Pi 上，需要傳送完整內容
+ASSET_PAYLOAD = struct.Struct('>B32s')
+FRAME_PRINT_STATUS = 16  # 資料為 job id -> ACK，資料為 JSON 格式的工作狀態
+PRINT_STATUS_PAYLOAD = struct.Struct('>I')
 
+STREAM_CHUNK_SIZE = 16 * 1024
+# 開始播放前至少緩衝的秒數，避免下一段還沒收到時出現空白
+STREAM_JITTER_BUFFER = 0.5
+INTRO_PATH = "intro_alloy.mp3"
+PORT = 12345
 
-def recvall(sock, n):
-    # Helper function to recv n bytes or return None if EOF is hit
-    data = bytearray()
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet:
-            return None
-        data.extend(packet)
-    return data
 
+def pack_frame(type, request_id, payload=b''):
+    return FRAME_HEADER.pack(type, request_id, len(payload)) + bytes(payload)
 
-def send_msg(sock, msg):
-    # Prefix each message with a 4-byte length (network byte order)
-    msg = struct.pack('>I', len(msg)) + msg
-    sock.sendall(msg)
+
+class DeviceCommandError(Exception):
+    """裝置回覆 ERR（指令本身失敗，連線仍然正常）。"""
+
+
+class AssetMissingError(Exception):
+    """裝置回覆 MISS：以 hash 指定的音檔不在裝置上。"""
+
+
+class AssetStore:
+    """
+    Pi 端以音檔內容的 SHA-256 為 key 的 LRU，保存已解碼的音檔。
+    以解碼後的大小（16-bit 雙聲道）限制總量，超過 max_bytes 時從最久沒用到的開始移除。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.clips = collections.OrderedDict()  # {digest: (clip, size)}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, digest):
+        with self.lock:
+            item = self.clips.get(digest)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.clips.move_to_end(digest)
+            return item[0]
+
+    def put(self, digest, clip):
+        size = int(clip.get_length() * sound.MIXER_FREQUENCY * 4)
+        with self.lock:
+            if digest in self.clips:
+                self.total_bytes -= self.clips.pop(digest)[1]
+            self.clips[digest] = (clip, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self.clips) > 1:
+                _, (_, evicted) = self.clips.popitem(last=False)
+                self.total_bytes -= evicted
+
+    def add(self, data):
+        """解碼音檔並以內容的 hash 保存，回傳已解碼的音檔。"""
+        clip = sound.get_engine().load(data)
+        self.put(hashlib.sha256(data).digest(), clip)
+        return clip
+
+
+class StreamReceiver:
+    """
+    一個 STREAM 請求：在記憶體中組合音檔，不寫入檔案。
+    緩衝的長度超過 STREAM_JITTER_BUFFER 後開始播放，之後每個音檔一收完就排入播放佇列。
+    第一段會打斷目前的播放（例如開場音效）。
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.data = bytearray()
+        self.buffered = []
+        self.buffered_seconds = 0.0
+        self.playing = False
+
+    def take_clip(self):
+        data, self.data = bytes(self.data), bytearray()
+        return data
+
+    def add_clip(self, clip):
+        self.buffered.append(clip)
+        self.buffered_seconds += clip.get_length()
+        if self.playing or self.buffered_seconds >= STREAM_JITTER_BUFFER:
+            self.flush()
+
+    def flush(self):
+        for clip in self.buffered:
+            self.engine.enqueue(clip, interrupt=not self.playing)
+            self.playing = True
+        self.buffered = []
+
+
+class ClockEstimator:
+    """
+    以 NTP 方式估計裝置時鐘與本機時鐘的差（裝置時間 - 本機時間）。
+    每次交換：本機送出 t0、裝置收到 t1、裝置回應 t2、本機收到 t3，
+    offset = ((t1 - t0) + (t2 - t3)) / 2，rtt = (t3 - t0) - (t2 - t1)。
+    保留最近 window 筆樣本，只用 RTT 較小的一半（網路延遲較對稱）做線性回歸，追蹤時鐘漂移。
+    """
+
+    def __init__(self, window=16):
+        self.window = window
+        self.samples = []  # (本機時間, offset, rtt)
+        self.lock = threading.Lock()
+        self.base_time = 0.0
+        self.offset = 0.0
+        self.drift = 0.0  # 每秒的 offset 變化
+        self.residual = None  # 使用的樣本與回歸線的 RMS 誤差（秒）
+
+    @property
+    def ready(self):
+        return self.residual is not None
+
+    def add(self, t0, t1, t2, t3):
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        rtt = (t3 - t0) - (t2 - t1)
+        with self.lock:
+            self.samples.append(((t0 + t3) / 2, offset, rtt))
+            self.samples = self.samples[-self.window:]
+            self._fit()
+        return offset, rtt
+
+    def _fit(self):
+        good = sorted(self.samples, key=lambda sample: sample[2])[:max(1, len(self.samples) // 2)]
+        times = [sample[0] for sample in good]
+        offsets = [sample[1] for sample in good]
+        self.base_time = sum(times) / len(times)
+        mean_offset = sum(offsets) / len(offsets)
+        spread = sum((t - self.base_time) ** 2 for t in times)
+        # 樣本的時間範圍太短時無法估計漂移
+        if len(good) >= 2 and max(times) - min(times) >= 1.0 and spread > 0:
+            self.drift = sum((t - self.base_time) * (o - mean_offset) for t, o in zip(times, offsets)) / spread
+        else:
+            self.drift = 0.0
+        self.offset = mean_offset
+        errors = [o - (self.offset + self.drift * (t - self.base_time)) for t, o in zip(times, offsets)]
+        self.residual = (sum(e * e for e in errors) / len(errors)) ** 0.5
+
+    def offset_at(self, local_time):
+        with self.lock:
+            return self.offset + self.drift * (local_time - self.base_time)
+
+    def report(self):
+        with self.lock:
+            return {
+                'offset': self.offset + self.drift * (time.time() - self.base_time),
+                'drift_ppm': self.drift * 1e6,
+                'residual': self.residual,
+                'rtt': min((sample[2] for sample in self.samples), default=None),
+                'samples': len(self.samples),
+            }
 
 
 class PiSocket:
-    """伺服器端，等待客戶端連線並接收檔案"""
+    """
+    伺服器端（asyncio），接收伺服器送來的 frame。
+    音訊相關的 frame 依收到的順序處理；列印交給 printer.PrinterSpooler，收到後立即回覆 job id。
+    """
 
     def __init__(self, pi_name):
         self.ip = inv_addr_dict[pi_name]
         self.pi_name = pi_name
+        self.printer_manager = None
+        self.spooler = None
+        self.assets = AssetStore()
         if pi_name == "printer":
             self.printer_manager = printer.ThermalPrinterManager()
-        self.port = 12345
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind((self.ip, self.port))
-        self.server_socket.listen(5)
-        log_and_print(f"[{pi_name}] Listening on {self.ip}:{self.port}", 'info')
+            self.spooler = printer.PrinterSpooler(self.printer_manager)
+        elif os.path.exists(INTRO_PATH):
+            # 開場音效先放進 asset store，伺服器只需要送 hash
+            with open(INTRO_PATH, "rb") as f:
+                self.assets.add(f.read())
+        self.port = PORT
 
-    def new_socket_handler(self, client_socket):
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        log_and_print(f"Connected by {addr_dict.get(peer[0], 'Unknown')}", 'info')
+        streams = {}
+        preloaded = {}
         try:
             while True:
-                data = client_socket.recv(1024)
-                if not data:
-                    log_and_print(f"[{self.ip}] No data received, closing connection.", 'info')
-                    break
-
-                command = data.decode()
-                log_and_print(f"[{self.ip}] Received: {command}", 'info')
-
-                if command == "quit":
-                    client_socket.send("Goodbye.".encode())
-                    break
-                elif command == "file":
-                    client_socket.send("ACK, start receiving file...".encode())
-                    file_len_data = client_socket.recv(1024)
-                    if not file_len_data:
-                        log_and_print(f"[{self.ip}] Did not receive file length, closing connection.", 'info')
-                        break
-                    file_len = int(file_len_data.decode())
-                    client_socket.send("file len ACK!".encode())
-
-                    file_data = recv_msg(client_socket)
-                    if file_data:
-                        with open(f"{addr_dict[self.ip]}.mp3", "wb") as f:
-                            f.write(file_data)
-                        client_socket.send("file received!".encode())
-                        sound.play_mp3_threaded(f"{addr_dict[self.ip]}.mp3")
-                    break
-                elif command == "play_intro":
-                    sound.play_mp3_threaded("intro_alloy.mp3")
-                    client_socket.send("intro played!".encode())
-                elif command == "print":
-                    client_socket.send("ACK, start receiving text...".encode())
-                    
-                    printer_text = client_socket.recv(1024).decode()
-                    log_and_print(f"[{self.ip}] Received printer text: {printer_text}", 'info')
-                    if not printer_text:
-                        log_and_print(f"[{self.ip}] Did not receive printer text, closing connection.", 'info')
-                        break
-                    else:
-                        self.printer_manager.print_text(printer_text)
-                    client_socket.send("print done!".encode())
+                header = await reader.readexactly(FRAME_HEADER.size)
+                type, request_id, length = FRAME_HEADER.unpack(header)
+                payload = await reader.readexactly(length) if length else b''
+                if type == FRAME_TIME_SYNC:
+                    # 收到的時間盡量貼近實際收到的時刻，不經過其他處理
+                    received = time.time()
+                    writer.write(pack_frame(FRAME_ACK, request_id, TIME_SYNC_PAYLOAD.pack(received, time.time())))
                 else:
-                    print(f"[{self.ip}] Unknown command: {command}")
-                    client_socket.send("Unknown command".encode())
+                    await self.handle_frame(writer, streams, preloaded, type, request_id, payload)
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            log_and_print(f"[{self.ip}] Connection closed by {addr_dict.get(peer[0], 'Unknown')}", 'info')
         except Exception as e:
             log_and_print(f"[{self.ip}] Error during connection: {e}", 'error')
         finally:
-            client_socket.close()
+            writer.close()
             log_and_print(f"[{self.ip}] Connection closed", 'info')
 
+    async def handle_frame(self, writer, streams, preloaded, type, request_id, payload):
+        loop = asyncio.get_running_loop()
+        try:
+            if type == FRAME_PING:
+                writer.write(pack_frame(FRAME_PONG, request_id, b"pong"))
+                return
+            log_and_print(f"[{self.ip}] Received frame {type} (request {request_id}, {len(payload)} bytes)", 'debug')
+            if type in (FRAME_PLAY, FRAME_ENQUEUE, FRAME_PRELOAD):
+                # 解碼在 thread pool 中進行，不擋住其他連線
+                clip = await loop.run_in_executor(None, self.assets.add, bytes(payload))
+                self.use_clip(writer, preloaded, type, request_id, clip)
+            elif type == FRAME_ASSET:
+                type, digest = ASSET_PAYLOAD.unpack(payload)
+                clip = self.assets.get(digest)
+                if clip is None:
+                    writer.write(pack_frame(FRAME_MISS, request_id))
+                elif type in (FRAME_PLAY, FRAME_ENQUEUE, FRAME_PRELOAD):
+                    self.use_clip(writer, preloaded, type, request_id, clip)
+                else:
+                    raise ValueError(f"frame {type} does not take an asset")
+            elif type == FRAME_PLAY_AT:
+                clip_id, start_time = PLAY_AT_PAYLOAD.unpack(payload)
+                clip = preloaded.pop(clip_id, None)
+                if clip is None:
+                    raise KeyError(f"clip {clip_id} not preloaded")
+                sound.get_engine().play_at(clip, start_time)
+                log_and_print(f"[{self.ip}] Play at {start_time:.3f} (in {(start_time - time.time()) * 1000:.1f} ms)", 'info')
+                writer.write(pack_frame(FRAME_ACK, request_id, b"scheduled!"))
+            elif type == FRAME_PRINT:
+                if self.spooler is None:
+                    raise RuntimeError(f"{self.pi_name} has no printer")
+                printer_text = payload.decode('utf-8')
+                job_id = self.spooler.submit(printer_text)
+                log_and_print(f"[{self.ip}] Print job {job_id} queued: {printer_text}", 'info')
+                writer.write(pack_frame(FRAME_ACK, request_id, str(job_id).encode()))
+            elif type == FRAME_PRINT_STATUS:
+                if self.spooler is None:
+                    raise RuntimeError(f"{self.pi_name} has no printer")
+                job_id, = PRINT_STATUS_PAYLOAD.unpack(payload)
+                status = self.spooler.job_status(job_id)
+                if status is None:
+                    raise KeyError(f"print job {job_id} not found")
+                writer.write(pack_frame(FRAME_ACK, request_id, json.dumps(status).encode()))
+            elif type == FRAME_STREAM_DATA:
+                streams.setdefault(request_id, StreamReceiver(sound.get_engine())).data.extend(payload)
+            elif type == FRAME_STREAM_CLIP:
+                receiver = streams.setdefault(request_id, StreamReceiver(sound.get_engine()))
+                data = receiver.take_clip()
+                if data:
+                    try:
+                        receiver.add_clip(await loop.run_in_executor(None, receiver.engine.load, data))
+                    except Exception as e:
+                        log_and_print(f"[{self.ip}] Error decoding streamed clip: {e}", 'error')
+            elif type == FRAME_STREAM_END:
+                receiver = streams.pop(request_id, None)
+                if receiver is not None:
+                    receiver.flush()
+                writer.write(pack_frame(FRAME_ACK, request_id, b"stream received!"))
+            else:
+                log_and_print(f"[{self.ip}] Unknown frame type: {type}", 'warning')
+                writer.write(pack_frame(FRAME_ERR, request_id, b"Unknown command"))
+        except Exception as e:
+            log_and_print(f"[{self.ip}] Error handling frame {type}: {e}", 'error')
+            writer.write(pack_frame(FRAME_ERR, request_id, str(e).encode()))
+
+    def use_clip(self, writer, preloaded, type, request_id, clip):
+        engine = sound.get_engine()
+        if type == FRAME_PLAY:
+            engine.play(clip)
+            writer.write(pack_frame(FRAME_ACK, request_id, b"file received!"))
+        elif type == FRAME_ENQUEUE:
+            engine.enqueue(clip)
+            writer.write(pack_frame(FRAME_ACK, request_id, b"file received!"))
+        else:
+            preloaded[request_id] = clip
+            # 只保留最近幾個沒有播放的音檔
+            while len(preloaded) > 8:
+                preloaded.pop(next(iter(preloaded)))
+            writer.write(pack_frame(FRAME_ACK, request_id, b"preloaded!"))
+
+    async def serve(self):
+        # 監聽所有介面，DHCP 換了位址也能連線；伺服器以 UDP 探索找到新位址
+        server = await asyncio.start_server(self.handle_connection, None, self.port)
+        await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: DiscoveryResponder(self.pi_name, self.port), local_addr=('0.0.0.0', DISCOVERY_PORT))
+        log_and_print(f"[{self.pi_name}] Listening on port {self.port} (discovery on UDP {DISCOVERY_PORT})", 'info')
+        async with server:
+            await server.serve_forever()
+
     def run(self):
-        while True:
-            client_socket, addr = self.server_socket.accept()
-            log_and_print(f"Connected by {addr_dict.get(addr[0], 'Unknown')}", 'info')
-            threading.Thread(target=self.new_socket_handler, args=(client_socket,), daemon=True).start()
+        asyncio.run(self.serve())
 
 
 class MacSocket:
-    """客戶端，連接到伺服器並傳送檔案"""
+    """
+    客戶端，連接到 Pi 並傳送 frame。
+    背景的讀取執行緒依 request id 把回應交給對應的 Future，因此多個執行緒可以在同一條連線上同時送出請求。
+    連線或 timeout 失敗時拋出 OSError；裝置回覆 ERR 時拋出 DeviceCommandError。
+    """
 
-    def __init__(self, pi_name):
+    def __init__(self, pi_name, connect_timeout=None, timeout=None, address=None):
         self.target_pi_name = pi_name
-        self.target_pi_ip = inv_addr_dict[pi_name]
-        self.port = 12345
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.connect((self.target_pi_ip, self.port))
-    
+        # address 為 DeviceRegistry 探索到的 (ip, port)，沒有時使用 device_ip 中的位址
+        ip, port = address or (None, None)
+        self.target_pi_ip = ip or inv_addr_dict[pi_name]
+        self.port = port or PORT
+        self.timeout = timeout
+        self.client_socket = socket.create_connection((self.target_pi_ip, self.port), timeout=connect_timeout)
+        # 之後每次 send 的期限；讀取執行緒遇到 timeout 會繼續等待
+        self.client_socket.settimeout(timeout)
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.closed = False
+        self.reader = threading.Thread(target=self._read_responses, daemon=True)
+        self.reader.start()
+
     def end_connection(self):
+        self.closed = True
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.client_socket.close()
 
-    def send_msg(self, msg):
+    def _recv_exact(self, n):
+        data = bytearray()
+        while len(data) < n:
+            try:
+                packet = self.client_socket.recv(n - len(data))
+            except socket.timeout:
+                if self.closed:
+                    raise
+                continue
+            if not packet:
+                raise ConnectionError(f"[{self.target_pi_name}] Connection closed by device")
+            data.extend(packet)
+        return data
+
+    def _read_responses(self):
         try:
-            self.client_socket.send(msg.encode())
-        except Exception as e:
-            log_and_print(f"Error sending message: {e}", 'error')
+            while True:
+                type, request_id, length = FRAME_HEADER.unpack(self._recv_exact(FRAME_HEADER.size))
+                payload = self._recv_exact(length) if length else b''
+                received = time.time()
+                with self.pending_lock:
+                    future = self.pending.pop(request_id, None)
+                if future is None:
+                    continue
+                if type == FRAME_MISS:
+                    future.set_exception(AssetMissingError(f"[{self.target_pi_name}] asset not on device"))
+                elif type == FRAME_ERR:
+                    future.set_exception(DeviceCommandError(f"[{self.target_pi_name}] {bytes(payload).decode(errors='replace')}"))
+                else:
+                    # 連同收到的時間一起交給等待的執行緒（時鐘同步需要）
+                    future.set_result((bytes(payload), received))
+        except OSError as e:
+            self.closed = True
+            with self.pending_lock:
+                pending, self.pending = self.pending, {}
+            for future in pending.values():
+                future.set_exception(ConnectionError(f"[{self.target_pi_name}] {e}"))
 
-    def send_file(self, file_name):
+    def _new_request(self):
+        if self.closed:
+            raise ConnectionError(f"[{self.target_pi_name}] Connection closed")
+        future = Future()
+        request_id = next(self.request_ids)
+        with self.pending_lock:
+            self.pending[request_id] = future
+        return request_id, future
+
+    def _send(self, type, request_id, payload=b''):
+        with self.send_lock:
+            self.client_socket.sendall(pack_frame(type, request_id, payload))
+
+    def _wait(self, future, timeout):
         try:
-            self.client_socket.send("file".encode())
-            response = self.client_socket.recv(1024).decode()
-            print(f"[{self.target_pi_name}] {response}")
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            raise socket.timeout(f"[{self.target_pi_name}] No response within {timeout}s") from None
 
-            if not os.path.exists(file_name):
-                log_and_print(f"File {file_name} does not exist!", 'debug')
-                return
+    def request(self, type, payload=b'', timeout=None):
+        """送出一個請求並等待 ACK，回傳回應文字。"""
+        request_id, future = self._new_request()
+        self._send(type, request_id, payload)
+        response, _ = self._wait(future, timeout if timeout is not None else self.timeout)
+        return response.decode(errors='replace')
+
+    def ping(self):
+        return self.request(FRAME_PING)
+
+    def time_sync(self):
+        """一次 NTP 式的時間交換，回傳 (t0, t1, t2, t3)。"""
+        request_id, future = self._new_request()
+        t0 = time.time()
+        self._send(FRAME_TIME_SYNC, request_id)
+        response, t3 = self._wait(future, self.timeout)
+        t1, t2 = TIME_SYNC_PAYLOAD.unpack(response)
+        return t0, t1, t2, t3
+
+    def send_asset(self, type, data):
+        """
+        以音檔執行 type（PLAY / ENQUEUE / PRELOAD）：先只送 SHA-256，Pi 上已有這個音檔就直接使用，
+        沒有時才傳送完整內容。回傳 (成功的 request id, 回應文字)。
+        """
+        digest = hashlib.sha256(data).digest()
+        request_id, future = self._new_request()
+        self._send(FRAME_ASSET, request_id, ASSET_PAYLOAD.pack(type, digest))
+        try:
+            response, _ = self._wait(future, self.timeout)
+        except AssetMissingError:
+            request_id, future = self._new_request()
+            self._send(type, request_id, data)
+            response, _ = self._wait(future, self.timeout)
+        return request_id, response.decode(errors='replace')
+
+    def preload(self, data):
+        """把音檔傳給 Pi 先解碼保存，回傳之後 play_at 使用的 clip id。"""
+        clip_id, _ = self.send_asset(FRAME_PRELOAD, data)
+        return clip_id
 
-            data = open(file_name, "rb").read()
-            self.client_socket.send(str(len(data)).encode())
-            response = self.client_socket.recv(1024).decode()
-            print(f"[{self.target_pi_name}] {response}")
+    def play_at(self, clip_id, device_time):
+        """在 Pi 時鐘的 device_time 開始播放 preload 過的音檔。"""
+        return self.request(FRAME_PLAY_AT, PLAY_AT_PAYLOAD.pack(clip_id, device_time))
 
-            send_msg(self.client_socket, data)
-            log_and_print(f"[{self.target_pi_name}] File sent successfully.", 'info')
+    def send_file(self, file_name):
+        if not os.path.exists(file_name):
+            log_and_print(f"File {file_name} does not exist!", 'debug')
+            return
+        with open(file_name, "rb") as f:
+            data = f.read()
+        self.send_bytes(data)
+
+    def send_bytes(self, data, interrupt=True):
+        """
+        傳送記憶體中的音檔（不經過檔案）；Pi 上已有相同內容時只傳送 hash。
+        interrupt 為 True 時打斷目前的播放，否則排在目前的播放之後。
+        """
+        try:
+            _, response = self.send_asset(FRAME_PLAY if interrupt else FRAME_ENQUEUE, data)
+            log_and_print(f"[{self.target_pi_name}] {response}", 'info')
         except Exception as e:
             log_and_print(f"Error sending file: {e}", 'error')
-        finally:
-            self.client_socket.close()
-    
-    def send_printer_text(self, text):
+            raise
+
+    def send_stream(self, clips):
+        """
+        依序串流傳送多個音檔；clips 可以是產生中的 iterator，
+        每個音檔一完成就分段送出，Pi 收完一段即可開始播放，不必等全部完成。
+        """
         try:
-            self.client_socket.send("print".encode())
-            response = self.client_socket.recv(1024).decode()
-            log_and_print(f"[{self.target_pi_name}] {response}", 'info')
+            request_id, future = self._new_request()
+            count = 0
+            for clip in clips:
+                view = memoryview(clip)
+                for start in range(0, len(view), STREAM_CHUNK_SIZE):
+                    self._send(FRAME_STREAM_DATA, request_id, view[start:start + STREAM_CHUNK_SIZE])
+                self._send(FRAME_STREAM_CLIP, request_id)
+                count += 1
+            self._send(FRAME_STREAM_END, request_id)
+            response, _ = self._wait(future, self.timeout)
+            log_and_print(f"[{self.target_pi_name}] {response.decode(errors='replace')} ({count} clips)", 'info')
+        except Exception as e:
+            log_and_print(f"Error streaming audio: {e}", 'error')
+            raise
 
-            self.client_socket.send(text.encode())
-            response = self.client_socket.recv(1024).decode()
-            log_and_print(f"[{self.target_pi_name}] {response}")
+    def send_printer_text(self, text):
+        """
+        文字以 UTF-8 整段送出，不受長度限制。
+        Pi 加入列印佇列後立即回覆，不等待印完；回傳 job id，可用 print_status 查詢進度。
+        """
+        try:
+            job_id = int(self.request(FRAME_PRINT, text.encode('utf-8')))
+            log_and_print(f"[{self.target_pi_name}] Print job {job_id} queued", 'info')
+            return job_id
         except Exception as e:
             log_and_print(f"Error sending printer text: {e}", 'error')
-        finally:
-            self.client_socket.close()
+            raise
+
+    def print_status(self, job_id):
+        """查詢列印工作的狀態（state 為 queued / printing / done / failed / rejected）。"""
+        return json.loads(self.request(FRAME_PRINT_STATUS, PRINT_STATUS_PAYLOAD.pack(job_id)))
+
+
+class DeviceUnavailableError(Exception):
+    """裝置目前沒有連線（背景重新連線中），呼叫端應立即放棄，不等待 timeout。"""
+
+
+class DeviceConnection:
+    """
+    到單一裝置的常駐連線。
+    背景執行緒負責連線：失敗時以指數退避重試；連上後每 heartbeat_interval 做一次時間交換，
+    同時檢查連線與更新時鐘差的估計（clock）。
+    request 在沒有連線時立即拋出 DeviceUnavailableError，不會讓觸發流程卡在 connect。
+    MacSocket 以 request id 對應回應，多個 request 可以同時在同一條連線上進行。
+    """
+
+    def __init__(self, pi_name, connect_timeout=1.0, io_timeout=3.0, heartbeat_interval=5.0,
+                 min_backoff=0.5, max_backoff=30.0, sync_burst=5, registry=None):
+        self.pi_name = pi_name
+        self.registry = registry
+        self.sync_burst = sync_burst
+        self.clock = ClockEstimator()
+        self.connect_timeout = connect_timeout
+        self.io_timeout = io_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.socket = None
+        self.lock = threading.Lock()  # 保護 self.socket 的替換
+        self.wake = threading.Event()
+        self.closed = False
+        self.last_used = time.monotonic()
+        self.thread = threading.Thread(target=self._maintain, daemon=True)
+        self.thread.start()
+
+    @property
+    def connected(self):
+        return self.socket is not None
+
+    def request(self, action):
+        """以 action(MacSocket) 在這條連線上執行指令，回傳 action 的結果。"""
+        connection = self.socket
+        if connection is None:
+            raise DeviceUnavailableError(f"[{self.pi_name}] not connected")
+        try:
+            result = action(connection)
+        except OSError as e:
+            self._drop(connection, e)
+            raise DeviceUnavailableError(f"[{self.pi_name}] {e}") from e
+        self.last_used = time.monotonic()
+        return result
+
+    def _drop(self, connection, reason):
+        with self.lock:
+            if self.socket is not connection:
+                return  # 已經由其他執行緒處理
+            self.socket = None
+        log_and_print(f"[{self.pi_name}] Connection lost: {reason}", 'warning')
+        connection.end_connection()
+        self.wake.set()
+
+    def _maintain(self):
+        backoff = self.min_backoff
+        while not self.closed:
+            if self.socket is None:
+                try:
+                    address = self.registry.address(self.pi_name) if self.registry is not None else None
+                    connection = MacSocket(self.pi_name, connect_timeout=self.connect_timeout, timeout=self.io_timeout,
+                                           address=address)
+                except OSError as e:
+                    log_and_print(f"[{self.pi_name}] Connect failed, retry in {backoff:.1f}s: {e}", 'debug')
+                    time.sleep(backoff * random.uniform(0.5, 1.0))
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+                with self.lock:
+                    self.socket = connection
+                    self.last_used = time.monotonic()
+                backoff = self.min_backoff
+                log_and_print(f"[{self.pi_name}] Connected", 'info')
+                # 連上後先連續交換幾次，馬上得到可用的時鐘差估計
+                try:
+                    for _ in range(self.sync_burst):
+                        self.clock.add(*connection.time_sync())
+                    self.log_clock()
+                except OSError as e:
+                    self._drop(connection, e)
+                continue
+            self.wake.wait(self.heartbeat_interval)
+            self.wake.clear()
+            connection = self.socket
+            if connection is None:
+                continue
+            try:
+                self.clock.add(*connection.time_sync())
+                self.last_used = time.monotonic()
+            except OSError as e:
+                self._drop(connection, e)
+
+    def log_clock(self):
+        report = self.clock.report()
+        log_and_print(f"[{self.pi_name}] Clock offset {report['offset'] * 1000:.1f} ms, "
+                      f"drift {report['drift_ppm']:.1f} ppm, residual {report['residual'] * 1000:.2f} ms, "
+                      f"rtt {report['rtt'] * 1000:.1f} ms", 'info')
+
+    def close(self):
+        self.closed = True
+        self.wake.set()
+        with self.lock:
+            connection, self.socket = self.socket, None
+        if connection is not None:
+            connection.end_connection()
+
+
+class DeviceConnectionPool:
+    """
+    以 device_ip.addr_dict 中的裝置名稱為 key，管理伺服器到各台 Pi 的常駐連線。
+    options 中的 registry（device_registry.DeviceRegistry）會用來取得探索到的位址。
+    """
+
+    def __init__(self, pi_names, **options):
+        for pi_name in pi_names:
+            if pi_name not in inv_addr_dict:
+                raise ValueError(f"Unknown device {pi_name}, must be one of {list(inv_addr_dict)}")
+        self.connections = {pi_name: DeviceConnection(pi_name, **options) for pi_name in dict.fromkeys(pi_names)}
+
+    def request(self, pi_name, action):
+        connection = self.connections.get(pi_name)
+        if connection is None:
+            raise DeviceUnavailableError(f"[{pi_name}] not in connection pool")
+        return connection.request(action)
+
+    def status(self):
+        return {pi_name: connection.connected for pi_name, connection in self.connections.items()}
+
+    def clock_report(self):
+        """各裝置的時鐘差估計：offset、drift_ppm、residual（秒）、rtt、樣本數。"""
+        return {pi_name: connection.clock.report()
+                for pi_name, connection in self.connections.items() if connection.clock.ready}
+
+    def play_synchronized(self, clips, lead=0.2):
+        """
+        兩階段同步播放 clips（{裝置名稱: 音檔 bytes}）：
+        先同時把音檔傳給各裝置解碼保存（PRELOAD），全部完成後選定 lead 秒後的開始時刻，
+        以各裝置的時鐘差換算成裝置時間送出 PLAY_AT，讓所有裝置在同一個瞬間開始播放。
+        無法連線的裝置會被略過；回傳 (本機時間的開始時刻, 已排定播放的裝置名稱 list)。
+        """
+        def preload(pi_name, data):
+            return self.request(pi_name, lambda socket: socket.preload(data))
+
+        with ThreadPoolExecutor(max_workers=max(1, len(clips))) as executor:
+            futures = {pi_name: executor.submit(preload, pi_name, data) for pi_name, data in clips.items()}
+        clip_ids = {}
+        for pi_name, future in futures.items():
+            try:
+                clip_ids[pi_name] = future.result()
+            except (DeviceUnavailableError, DeviceCommandError) as e:
+                log_and_print(f"Skip synchronized audio: {e}", 'warning')
+        start_time = time.time() + lead
+        scheduled = []
+        for pi_name, clip_id in clip_ids.items():
+            clock = self.connections[pi_name].clock
+            if not clock.ready:
+                log_and_print(f"[{pi_name}] No clock estimate yet, scheduling with the local clock", 'warning')
+            device_time = start_time + clock.offset_at(start_time)
+            try:
+                self.request(pi_name, lambda socket: socket.play_at(clip_id, device_time))
+            except (DeviceUnavailableError, DeviceCommandError) as e:
+                log_and_print(f"Skip synchronized audio: {e}", 'warning')
+                continue
+            scheduled.append(pi_name)
+            if clock.ready:
+                self.connections[pi_name].log_clock()
+        return start_time, scheduled
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+
 
 if __name__ == "__main__":
     logname = 'log_web_socket'
@@ -187,6 +725,7 @@ if __name__ == "__main__":
             sckt = MacSocket("local")
             time.sleep(3)
             sckt.send_file("test_speech_results/isart.mp3")
+            sckt.end_connection()
         elif args.id == "clientA":
             sckt = PiSocket("local")
             sckt.run()
@@ -197,6 +736,7 @@ if __name__ == "__main__":
         if args.id == "server":
             sckt = MacSocket("isart")
             sckt.send_file("test_speech_results/isart.mp3")
+            sckt.end_connection()
         elif args.id == "isart":
             sckt = PiSocket("isart")
             sckt.run()